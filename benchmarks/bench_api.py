@@ -0,0 +1,214 @@
+"""
+Drives the API end to end against a local stand-in upstream that serves the
+recorded pages, and reports requests per second, latency percentiles and
+memory per request for each endpoint.
+
+    python benchmarks/bench_api.py --requests 500 --concurrency 20 --output bench.jsonl
+
+Every request searches a distinct term by default so that the search cache
+doesn't answer them, pass `--distinct-queries 1` to measure cache hits instead.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+import aiohttp
+import uvicorn
+from aiohttp import web
+
+from common import FIXTURES, latency_stats, load_fixtures, report
+
+LIBRARIES = ("libgen", "libgenlc", "planetebooks")
+
+
+def standin_app(fixtures) -> web.Application:
+    """
+    Upstream stand-in, every library lives under `/<library>/<kind>/` and any
+    path below a library's search page is answered as a detail page.
+    """
+
+    async def handler(request: web.Request):
+        library = request.match_info["library"]
+        kind = request.match_info["kind"]
+        if kind == "search" and request.match_info["rest"]:
+            kind = "suburl"
+        pages = fixtures.get((library, kind))
+        if not pages:
+            raise web.HTTPNotFound()
+        return web.Response(text=pages[0], content_type="text/html", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/{library}/{kind}/{rest:.*}", handler)
+    return app
+
+
+def point_agents_at(agents, fixtures, base_url: str):
+    """
+    Rewrites the agents' URLs to the stand-in, agents that share an upstream
+    page (libgenlc uses the topics of libgen) share the recorded page too.
+    """
+    standins = {}
+    for library, agent in agents.items():
+        for kind in ("search", "topics", "datadumps"):
+            url = getattr(agent, f"{kind}_url")
+            if url and (library, kind) in fixtures:
+                standins.setdefault(url, f"{base_url}/{library}/{kind}/")
+
+    for library, agent in agents.items():
+        for kind in ("search", "topics", "datadumps"):
+            url = getattr(agent, f"{kind}_url")
+            if url:
+                setattr(
+                    agent,
+                    f"{kind}_url",
+                    standins.get(url, f"{base_url}/{library}/{kind}/"),
+                )
+
+
+def endpoints(prefix: str, distinct_queries: int):
+    for library in LIBRARIES:
+        yield f"{library}/search", lambda i, library=library: (
+            f"{prefix}/{library}/search?q=bench{i % distinct_queries}"
+        )
+        yield f"{library}/datadumps", lambda i, library=library: (
+            f"{prefix}/{library}/datadumps"
+        )
+    for library in ("libgen", "libgenlc"):
+        yield f"{library}/topics", lambda i, library=library: f"{prefix}/{library}/topics"
+
+
+async def drive(session, base_url, url_for, requests, concurrency, offset=0):
+    latencies = []
+    errors = 0
+    counter = iter(range(offset, offset + requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = perf_counter()
+            async with session.get(base_url + url_for(i)) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    errors += 1
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "requests_per_s": requests / elapsed,
+        **latency_stats(latencies),
+    }
+
+
+async def measure_memory(session, base_url, url_for, requests, concurrency, offset):
+    """
+    Separate pass with allocation tracing, which slows requests down too much
+    to be part of the timed run.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    await drive(session, base_url, url_for, requests, concurrency, offset)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        # peak traced python allocations shared by the in-flight requests
+        "peak_alloc_bytes_per_request": peak // concurrency,
+        "max_rss_growth_kb": rss_after - rss_before,
+    }
+
+
+async def run(args):
+    fixtures = load_fixtures(Path(args.fixtures))
+
+    # the API mounts the built docs from ./home
+    workdir = tempfile.mkdtemp(prefix="freebooksapi-bench-")
+    os.makedirs(os.path.join(workdir, "home"))
+    os.chdir(workdir)
+
+    # the stand-in answers for every alias, don't measure the real ones
+    os.environ.setdefault("ALIAS_HEALTH_CHECK_EVERY_S", "0")
+    # limits and breakers are set up for the real aliases when main is
+    # imported, before the agents are pointed at the stand-in, and mustn't
+    # throttle or fail the benchmark
+    os.environ["UPSTREAM_RATE"] = "0"
+    for library in LIBRARIES:
+        os.environ.pop(f"UPSTREAM_RATE_{library.upper()}", None)
+    os.environ["BREAKER_FAILURES"] = "0"
+    import main
+
+    upstream = web.AppRunner(standin_app(fixtures))
+    await upstream.setup()
+    site = web.TCPSite(upstream, "127.0.0.1", args.upstream_port)
+    await site.start()
+    point_agents_at(
+        main.LIBRARY_AGENTS, fixtures, f"http://127.0.0.1:{args.upstream_port}"
+    )
+
+    server = uvicorn.Server(
+        uvicorn.Config(
+            main.FREEBOOKSAPI, host="127.0.0.1", port=args.port, log_level="warning"
+        )
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    results = []
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name, url_for in endpoints(args.prefix, args.distinct_queries or args.requests):
+                if args.endpoints and name not in args.endpoints:
+                    continue
+                # warm up connections and caches
+                await drive(session, base_url, url_for, args.concurrency, args.concurrency)
+                result = await drive(
+                    session, base_url, url_for, args.requests, args.concurrency
+                )
+                memory = await measure_memory(
+                    session,
+                    base_url,
+                    url_for,
+                    args.concurrency * 4,
+                    args.concurrency,
+                    offset=args.requests,
+                )
+                results.append({"endpoint": name, **result, **memory})
+    finally:
+        server.should_exit = True
+        await serving
+        await upstream.cleanup()
+
+    report("api", results, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fixtures", default=str(FIXTURES))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--distinct-queries", type=int, default=0)
+    parser.add_argument("--endpoints", nargs="*", help="i.e. libgen/search")
+    parser.add_argument("--prefix", default="/api/v1_0", help="versioned route prefix")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--upstream-port", type=int, default=8766)
+    parser.add_argument("--output", help="append results as JSON lines to a file")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Replays the recorded pages through each agent's parse methods, with every
+parser engine, and reports parse latency, throughput and allocations.
+
+    python benchmarks/bench_parsers.py --iterations 50 --output bench.jsonl
+"""
+import argparse
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+from common import FIXTURES, KIND_PARSERS, load_fixtures, latency_stats, report
+
+from scrapers.genlibrusec import GenLibRusEc
+from scrapers.libgenlc import LibGenLc
+from scrapers.parsing import PARSER_ENGINES, parse_page
+from scrapers.planetebooks import PlanetEBooks
+
+AGENTS = {
+    "libgen": GenLibRusEc,
+    "libgenlc": LibGenLc,
+    "planetebooks": PlanetEBooks,
+}
+
+
+def strain_for(agent, kind):
+    return {
+        "search": agent.search_strain,
+        "topics": agent.topics_strain,
+        "datadumps": agent.datadumps_strain,
+        "suburl": getattr(agent, "suburl_soupstrain", None),
+    }[kind]
+
+
+def bench_page(agent, parser, content, strain, iterations):
+    # warm up compiled expressions and caches
+    parse_page(agent, parser, content, strain)
+
+    samples = []
+    for _ in range(iterations):
+        start = perf_counter()
+        parse_page(agent, parser, content, strain)
+        samples.append(perf_counter() - start)
+
+    tracemalloc.start()
+    parse_page(agent, parser, content, strain)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return samples, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fixtures", default=str(FIXTURES))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--engines", nargs="+", default=list(PARSER_ENGINES))
+    parser.add_argument("--output", help="append results as JSON lines to a file")
+    args = parser.parse_args()
+
+    results = []
+    for (library, kind), pages in sorted(load_fixtures(Path(args.fixtures)).items()):
+        if library not in AGENTS or kind not in KIND_PARSERS:
+            continue
+        for engine in args.engines:
+            agent = AGENTS[library](engine=engine)
+            samples, peaks = [], []
+            for content in pages:
+                page_samples, peak = bench_page(
+                    agent,
+                    KIND_PARSERS[kind],
+                    content,
+                    strain_for(agent, kind),
+                    args.iterations,
+                )
+                samples += page_samples
+                peaks.append(peak)
+
+            results.append(
+                {
+                    "library": library,
+                    "kind": kind,
+                    "engine": engine,
+                    "pages": len(pages),
+                    "bytes": sum(len(content) for content in pages),
+                    "parses_per_s": len(samples) / sum(samples),
+                    "peak_alloc_bytes": max(peaks),
+                    **latency_stats(samples),
+                }
+            )
+
+    report("parsers", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
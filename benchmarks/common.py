@@ -0,0 +1,104 @@
+"""
+Shared helpers for the benchmarks: fixture loading, statistics and
+machine-readable reporting.
+
+Fixtures are laid out as `<root>/<agent>/<kind>/<name>.html[.gz]`, where agent
+is a library name (libgen, libgenlc, planetebooks) and kind names the page that
+was recorded (search, topics, datadumps, suburl).
+"""
+import gzip
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+# the API modules import each other as top-level modules
+sys.path.insert(0, str(ROOT / "freebooksapi"))
+
+# parse method that handles each kind of recorded page
+KIND_PARSERS = {
+    "search": "parse_result",
+    "topics": "parse_topics",
+    "datadumps": "parse_datadumps",
+    "suburl": "parse_suburl",
+}
+
+
+def iter_fixtures(root: Path = FIXTURES) -> Iterator[Tuple[str, str, Path]]:
+    """
+    Yields (agent, kind, path) for every recorded page under root.
+    """
+    for path in sorted(root.glob("*/*/*.html*")):
+        yield path.parent.parent.name, path.parent.name, path
+
+
+def read_fixture(path: Path) -> str:
+    if path.suffix == ".gz":
+        return gzip.decompress(path.read_bytes()).decode("utf-8")
+    return path.read_text(encoding="utf-8")
+
+
+def load_fixtures(root: Path = FIXTURES) -> Dict[Tuple[str, str], List[str]]:
+    fixtures: Dict[Tuple[str, str], List[str]] = {}
+    for agent, kind, path in iter_fixtures(root):
+        fixtures.setdefault((agent, kind), []).append(read_fixture(path))
+    return fixtures
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_stats(samples: Sequence[float]) -> Dict[str, float]:
+    """
+    Summarizes latencies given in seconds, reported in milliseconds.
+    """
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(benchmark: str, results: List[Dict], output: Optional[str] = None):
+    """
+    Prints the results as one JSON document and, if given, appends it as a
+    line to the output file so runs can be compared across releases.
+    """
+    document = {
+        "benchmark": benchmark,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    print(json.dumps(document, indent=2))
+    if output:
+        with open(output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(document) + "\n")
@@ -0,0 +1,373 @@
+import json
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from logging import getLogger
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from misc import RE_MD5
+from pagination import result_window
+from scrapers.agent import Agent
+from scrapers.objects import Publication, SearchMode, SearchResult, SearchUrlArgs
+from starlette.concurrency import run_in_threadpool
+
+log = getLogger("catalogue")
+
+# columns of a catalogue record, the publication fields along with what the
+# dumps additionally provide
+RECORD_COLUMNS = (
+    "id",
+    "md5",
+    "authors",
+    "isbn",
+    "edition",
+    "series",
+    "title",
+    "publisher",
+    "year",
+    "pages",
+    "lang",
+    "size",
+    "extension",
+    "mirrors",
+    "topic",
+    "added",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS publications (
+    library TEXT NOT NULL,
+    id TEXT NOT NULL,
+    md5 TEXT,
+    authors TEXT,
+    isbn TEXT,
+    edition TEXT,
+    series TEXT,
+    title TEXT NOT NULL,
+    publisher TEXT,
+    year TEXT,
+    pages TEXT,
+    lang TEXT,
+    size TEXT,
+    extension TEXT,
+    mirrors TEXT NOT NULL,
+    topic INTEGER,
+    added TEXT,
+    PRIMARY KEY (library, id)
+);
+CREATE INDEX IF NOT EXISTS publications_added ON publications (library, added);
+-- the newest numeric ID of a library without scanning all of its IDs
+CREATE INDEX IF NOT EXISTS publications_number ON publications (library, CAST(id AS INTEGER));
+CREATE VIRTUAL TABLE IF NOT EXISTS publications_fts USING fts5(
+    title, authors, series, publisher, isbn,
+    content='publications', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS publications_ai AFTER INSERT ON publications BEGIN
+    INSERT INTO publications_fts (rowid, title, authors, series, publisher, isbn)
+    VALUES (new.rowid, new.title, new.authors, new.series, new.publisher, new.isbn);
+END;
+CREATE TRIGGER IF NOT EXISTS publications_ad AFTER DELETE ON publications BEGIN
+    INSERT INTO publications_fts (publications_fts, rowid, title, authors, series, publisher, isbn)
+    VALUES ('delete', old.rowid, old.title, old.authors, old.series, old.publisher, old.isbn);
+END;
+CREATE TRIGGER IF NOT EXISTS publications_au AFTER UPDATE ON publications BEGIN
+    INSERT INTO publications_fts (publications_fts, rowid, title, authors, series, publisher, isbn)
+    VALUES ('delete', old.rowid, old.title, old.authors, old.series, old.publisher, old.isbn);
+    INSERT INTO publications_fts (rowid, title, authors, series, publisher, isbn)
+    VALUES (new.rowid, new.title, new.authors, new.series, new.publisher, new.isbn);
+END;
+-- how far each dump import and each sync (as sync:<library>, rows being
+-- the newest publication ID seen) got
+CREATE TABLE IF NOT EXISTS imports (
+    source TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL,
+    finished INTEGER NOT NULL
+);
+"""
+
+# catalogue library the fiction of a library is imported into, its IDs being
+# counted apart from the non-fiction ones
+FICTION_LIBRARY = "{library}-fiction"
+
+RE_TERM = re.compile(r"\w+")
+# matches are counted up to this many, counting every match of a broad query
+# costs more than the search itself
+COUNT_LIMIT = 1000
+
+
+def match_expression(q: str) -> Optional[str]:
+    """
+    Turns a search query into an FTS5 expression matching every word, the
+    last one as a prefix so that partially typed queries match too.
+    """
+    terms = RE_TERM.findall(q)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+class Catalogue:
+    """
+    Local full-text index of publications imported from the library database
+    dumps (see `dumpimport`), searched instead of scraping the library.
+
+    Queries block, the API runs them in the thread pool.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        # calls come from the thread pool, one at a time on the connection
+        self.lock = threading.Lock()
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL a crash can lose the last transactions but never corrupts
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def add(
+        self,
+        library: str,
+        records: Iterable[Dict[str, Any]],
+        checkpoint: Optional[Tuple[str, int, bool]] = None,
+    ) -> int:
+        """
+        Inserts or updates publication records in one transaction.
+
+        :param library: library the records belong to
+        :param records: dictionaries keyed by `RECORD_COLUMNS`, isbn and
+        mirrors as lists
+        :param checkpoint: (source, rows, finished) of the import the records
+        come from, saved along with them
+
+        :returns: number of records written
+        """
+        rows = [
+            (
+                library,
+                *(
+                    ",".join(record[column] or [])
+                    if column == "isbn"
+                    else json.dumps(record[column])
+                    if column == "mirrors"
+                    else record.get(column)
+                    for column in RECORD_COLUMNS
+                ),
+            )
+            for record in records
+        ]
+        columns = ", ".join(("library",) + RECORD_COLUMNS)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in RECORD_COLUMNS[1:])
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO publications ({columns}) "
+                f"VALUES ({', '.join('?' * (len(RECORD_COLUMNS) + 1))}) "
+                f"ON CONFLICT (library, id) DO UPDATE SET {updates}",
+                rows,
+            )
+            if checkpoint is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO imports (source, rows, finished) VALUES (?, ?, ?)",
+                    checkpoint,
+                )
+        return len(rows)
+
+    def max_id(self, library: str) -> Optional[int]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT max(CAST(id AS INTEGER)) FROM publications WHERE library = ?",
+                (library,),
+            ).fetchone()[0]
+
+    def get_checkpoint(self, source: str) -> Tuple[int, bool]:
+        """
+        Returns how many dump rows of the source were imported and whether the
+        import finished.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT rows, finished FROM imports WHERE source = ?", (source,)
+            ).fetchone()
+        return (0, False) if row is None else (row["rows"], bool(row["finished"]))
+
+    def count(self, library: str) -> int:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT count(*) FROM publications WHERE library = ?", (library,)
+            ).fetchone()[0]
+
+    def has(self, library: str) -> bool:
+        with self.lock:
+            return (
+                self.conn.execute(
+                    "SELECT 1 FROM publications WHERE library = ? LIMIT 1", (library,)
+                ).fetchone()
+                is not None
+            )
+
+    def search(
+        self, library: str, search_term: Optional[str], args: SearchUrlArgs
+    ) -> SearchResult:
+        """
+        Searches the catalogue for the window of publications the arguments
+        ask for, see `pagination.result_window`. The total found is counted up
+        to `COUNT_LIMIT`.
+        """
+        where = ["p.library = ?"]
+        params: List[Any] = [library]
+        if args.lang:
+            where.append("p.lang = ? COLLATE NOCASE")
+            params.append(args.lang)
+        if args.topic_id:
+            where.append("p.topic = ?")
+            params.append(args.topic_id)
+
+        if search_term:
+            expression = match_expression(search_term)
+            if expression is None:
+                return SearchResult([], 0, (0, 0))
+            # CROSS JOIN makes sqlite look the matches up first rather than
+            # matching against every publication of the library
+            source = "publications_fts f CROSS JOIN publications p ON p.rowid = f.rowid"
+            where.insert(0, "publications_fts MATCH ?")
+            params.insert(0, expression)
+            order = "f.rank"
+        else:
+            source = "publications p"
+            order = "p.added DESC"
+        if args.search_mode == SearchMode.last:
+            order = "p.added DESC"
+
+        condition = " AND ".join(where)
+        start, count = result_window(args)
+        with self.lock:
+            total = self.conn.execute(
+                f"SELECT count(*) FROM (SELECT 1 FROM {source} WHERE {condition} LIMIT ?)",
+                (*params, COUNT_LIMIT),
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT p.* FROM {source} WHERE {condition} ORDER BY {order} LIMIT ? OFFSET ?",
+                (*params, count, start),
+            ).fetchall()
+        publications = [self._to_publication(row) for row in rows]
+        return SearchResult(
+            publications, total, (start + 1, start + len(publications))
+        )
+
+    @staticmethod
+    def _to_publication(row: sqlite3.Row) -> Publication:
+        return Publication(
+            id=int(row["id"]) if row["id"].isnumeric() else row["id"],
+            authors=row["authors"] or None,
+            isbn=row["isbn"].split(",") if row["isbn"] else None,
+            edition=row["edition"] or None,
+            series=row["series"] or None,
+            title=row["title"],
+            publisher=row["publisher"] or None,
+            year=int(row["year"]) if row["year"] and row["year"].isnumeric() else None,
+            pages=row["pages"] or "",
+            lang=row["lang"] or "",
+            size=row["size"] or "",
+            extension=row["extension"] or "",
+            mirrors=json.loads(row["mirrors"]),
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+def publication_record(publication: Publication, added: str) -> Dict[str, Any]:
+    """
+    Catalogue record of a scraped publication, which carries its MD5 only in
+    its mirror links.
+    """
+    md5 = next(
+        (
+            match.group(0).upper()
+            for match in map(RE_MD5.search, (mirror or "" for mirror in publication.mirrors))
+            if match
+        ),
+        None,
+    )
+    return {
+        **{column: getattr(publication, column, None) for column in RECORD_COLUMNS},
+        "id": str(publication.id),
+        "md5": md5,
+        "year": None if publication.year is None else str(publication.year),
+        "topic": None,
+        "added": added,
+    }
+
+
+async def sync_latest(
+    catalogue: Catalogue,
+    library: str,
+    agent: Agent,
+    *,
+    max_pages: int = 5,
+    page_size: int = 100,
+) -> int:
+    """
+    Adds the publications the library added since the last sync by walking its
+    last added pages until the newest ID seen by the previous sync (or the
+    newest ID in the catalogue before the first one).
+
+    The newest ID is only moved on once the walk reaches the previous one, a
+    walk cut short by `max_pages` is picked up from the first page again.
+    Publications without a numeric ID are skipped.
+
+    :raises ValueError: if the IDs of the library aren't sequential, see
+    `Agent.sequential_ids`
+
+    :returns: number of publications added or updated
+    """
+    if "sync" not in agent.capabilities():
+        raise ValueError(f"{library} can't be synced, its publication IDs aren't sequential.")
+
+    source = f"sync:{library}"
+    watermark, synced = await run_in_threadpool(catalogue.get_checkpoint, source)
+    if not synced:
+        # saved right away, later walks add IDs above it before reaching it
+        watermark = await run_in_threadpool(catalogue.max_id, library) or 0
+        await run_in_threadpool(catalogue.add, library, [], (source, watermark, True))
+
+    added_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    newest = watermark
+    written = 0
+    for page in range(1, max_pages + 1):
+        result = await agent.search(
+            None,
+            SearchUrlArgs(
+                lang=None,
+                page=page,
+                limit=page_size,
+                offset=0,
+                topic_id=None,
+                search_mode=SearchMode.last,
+            ),
+        )
+        numbered = [pub for pub in result.publications if str(pub.id).isnumeric()]
+        fresh = [pub for pub in numbered if int(pub.id) > watermark]
+        newest = max([newest] + [int(pub.id) for pub in fresh])
+        reached = len(fresh) < len(numbered) or not numbered
+        # an empty catalogue is seeded with the first page only
+        done = reached or not watermark
+        written += await run_in_threadpool(
+            catalogue.add,
+            library,
+            [publication_record(publication, added_at) for publication in fresh],
+            (source, newest, True) if done else None,
+        )
+        if done:
+            break
+    else:
+        log.warning(
+            f"{library} added more than {max_pages} pages since the last sync, "
+            "the rest is picked up next time."
+        )
+    return written
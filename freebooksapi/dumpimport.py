@@ -0,0 +1,392 @@
+"""
+Imports a libgen database dump (as listed under /{library}/datadumps) into the
+local catalogue that `/{library}/search?source=local` answers from.
+
+    python dumpimport.py libgen_compact.rar --catalogue catalogue.db --library libgen
+
+Non-fiction publications are imported under the library given and fiction ones
+under the library suffixed with -fiction (i.e. libgen-fiction), the two tables
+numbering their publications separately. Fiction is searched with
+`/{library}/search?source=local&fiction=true`.
+
+The dump is read and parsed as a stream in fixed size chunks, so memory stays
+constant whatever its size. Progress is checkpointed with every batch written
+and an interrupted import resumes where it stopped when run again.
+"""
+import argparse
+import gzip
+import io
+import os
+import re
+from dataclasses import dataclass
+from logging import getLogger
+from time import perf_counter
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from catalogue import FICTION_LIBRARY, Catalogue
+
+log = getLogger("dumpimport")
+
+CHUNK_SIZE = 1024 * 1024
+# a single row larger than this is taken as a malformed dump rather than
+# buffered further
+MAX_ROW_SIZE = 64 * 1024 * 1024
+
+# mirror URLs of a publication by its MD5, per dump table that holds
+# publications (updated holds non-fiction, fiction holds fiction)
+TABLE_MIRRORS = {
+    "updated": [
+        "http://library.lol/main/{md5}",
+        "http://libgen.lc/ads.php?md5={md5}",
+        "https://library.bz/main/edit/{md5}",
+    ],
+    "fiction": [
+        "http://library.lol/fiction/{md5}",
+        "http://libgen.lc/ads.php?md5={md5}",
+    ],
+}
+
+# catalogue library of the publications of each dump table, formatted with the
+# library imported into. Fiction and non-fiction IDs are counted separately and
+# the same ID stands for different publications in each, tables must go to
+# different libraries
+TABLE_LIBRARIES = {"updated": "{library}", "fiction": FICTION_LIBRARY}
+
+RE_CREATE_TABLE = re.compile(r"CREATE TABLE `(\w+)`")
+RE_COLUMN = re.compile(r"\s*`(\w+)`")
+RE_INSERT = re.compile(r"INSERT INTO `(\w+)` VALUES ")
+# what follows a row: another row, the next one or the end of the statement
+RE_ROW_SEPARATOR = re.compile(r"\s*([(,;])")
+# one value of a row followed by the character that ends it, a value cut off
+# by the end of the buffer doesn't match
+RE_VALUE = re.compile(r"\s*(?:'((?:[^'\\]|\\.|'')*)'|(NULL)|([^,)'\s]*))\s*([,)])", re.S)
+RE_ESCAPE = re.compile(r"\\(.)|''", re.S)
+ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+
+def unescape(value: str) -> str:
+    return RE_ESCAPE.sub(
+        lambda m: "'" if m.group(1) is None else ESCAPES.get(m.group(1), m.group(1)),
+        value,
+    )
+
+
+def open_dump(path: str) -> Tuple[IO[str], IO[bytes]]:
+    """
+    Opens a .sql, .gz or .rar dump for reading as text.
+
+    :returns: the text stream and the underlying file, whose position tells
+    how much of the file was read
+    """
+    raw = open(path, "rb")
+    if path.endswith(".gz"):
+        stream: IO[bytes] = gzip.GzipFile(fileobj=raw)
+    elif path.endswith(".rar"):
+        try:
+            import rarfile
+        except ImportError:
+            raw.close()
+            raise ImportError(
+                "Importing .rar dumps requires the rarfile package (pip install rarfile)."
+            ) from None
+        archive = rarfile.RarFile(raw)
+        members = [info for info in archive.infolist() if info.filename.endswith(".sql")]
+        if not members:
+            raise ValueError(f"There is no .sql file in {path}.")
+        stream = archive.open(members[0])
+    else:
+        stream = raw
+    return io.TextIOWrapper(stream, encoding="utf-8", errors="replace"), raw  # type: ignore
+
+
+def iter_chunks(stream: IO[str], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class DumpParser:
+    """
+    Incremental parser of a mysqldump. Text is fed in chunks of any size and
+    rows come out as soon as they are complete, only the incomplete remainder
+    is kept between chunks.
+    """
+
+    def __init__(self) -> None:
+        self.columns: Dict[str, List[str]] = {}
+        self._buffer = ""
+        self._creating: Optional[str] = None
+        self._inserting: Optional[str] = None
+
+    def feed(self, text: str) -> Iterator[Tuple[str, Dict[str, Optional[str]]]]:
+        """
+        Yields (table, row) for every row completed by the text, rows keyed by
+        their lowercased column names.
+        """
+        buffer = self._buffer + text
+        pos = 0
+        while True:
+            if self._inserting is not None:
+                separator = RE_ROW_SEPARATOR.match(buffer, pos)
+                if separator is None:
+                    if buffer[pos:].strip():
+                        raise ValueError(f"Malformed INSERT at {buffer[pos:pos + 40]!r}.")
+                    break
+                if separator.group(1) == ";":
+                    self._inserting = None
+                elif separator.group(1) == "(":
+                    parsed = self._parse_row(buffer, separator.end())
+                    if parsed is None:
+                        break
+                    values, separator_end = parsed
+                    yield self._inserting, dict(zip(self.columns[self._inserting], values))
+                    pos = separator_end
+                    continue
+                pos = separator.end()
+                continue
+
+            insert = RE_INSERT.match(buffer, pos)
+            if insert is not None and self._creating is None:
+                if insert.group(1) not in self.columns:
+                    raise ValueError(f"INSERT into `{insert.group(1)}` before its CREATE TABLE.")
+                self._inserting = insert.group(1)
+                pos = insert.end()
+                continue
+
+            end = buffer.find("\n", pos)
+            if end == -1:
+                break
+            self._parse_line(buffer[pos:end])
+            pos = end + 1
+
+        self._buffer = buffer[pos:]
+        if len(self._buffer) > MAX_ROW_SIZE:
+            raise ValueError(f"Malformed dump, no row ends within {MAX_ROW_SIZE} bytes.")
+
+    def close(self):
+        if self._inserting is not None or self._buffer.strip():
+            raise ValueError("The dump ends in the middle of a statement.")
+
+    def _parse_line(self, line: str):
+        if self._creating is not None:
+            column = RE_COLUMN.match(line)
+            if column is not None:
+                self.columns[self._creating].append(column.group(1).lower())
+            elif line.startswith(")"):
+                self._creating = None
+            return
+
+        create = RE_CREATE_TABLE.match(line)
+        if create is not None:
+            self._creating = create.group(1)
+            self.columns[self._creating] = []
+
+    @staticmethod
+    def _parse_row(
+        buffer: str, pos: int
+    ) -> Optional[Tuple[List[Optional[str]], int]]:
+        # None if the row continues past the end of the buffer
+        row: List[Optional[str]] = []
+        while True:
+            match = RE_VALUE.match(buffer, pos)
+            if match is None:
+                return None
+            quoted, null, bare, end = match.groups()
+            if quoted is not None:
+                row.append(unescape(quoted))
+            elif null is not None:
+                row.append(None)
+            else:
+                row.append(bare)
+            pos = match.end()
+            if end == ")":
+                return row, pos
+
+
+def iter_rows(chunks: Iterator[str]) -> Iterator[Tuple[str, Dict[str, Optional[str]]]]:
+    parser = DumpParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+def format_size(filesize: Optional[str]) -> str:
+    # sizes the way the library pages show them, i.e. 2 Mb
+    if not filesize or not filesize.isnumeric():
+        return ""
+    size = float(filesize)
+    for unit in ("bytes", "Kb", "Mb", "Gb"):
+        if size < 1024 or unit == "Gb":
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return ""
+
+
+def to_record(table: str, row: Dict[str, Optional[str]]) -> Optional[Dict[str, Any]]:
+    """
+    Maps a dump row onto a catalogue record, None for rows that aren't
+    publications or that the library hides.
+    """
+    if table not in TABLE_MIRRORS or row.get("visible") or not row.get("md5"):
+        return None
+    md5 = row["md5"].upper()  # type: ignore
+    identifier = row.get("identifier") or ""
+    topic = row.get("topic") or ""
+    return {
+        "id": row["id"],
+        "md5": md5,
+        "authors": row.get("author") or None,
+        "isbn": [isbn.strip() for isbn in identifier.split(",") if isbn.strip()]
+        or None,
+        "edition": row.get("edition") or None,
+        "series": row.get("series") or None,
+        "title": row.get("title") or "",
+        "publisher": row.get("publisher") or None,
+        "year": row.get("year") or None,
+        "pages": row.get("pages") or "",
+        "lang": row.get("language") or "",
+        "size": format_size(row.get("filesize")),
+        "extension": row.get("extension") or "",
+        "mirrors": [mirror.format(md5=md5) for mirror in TABLE_MIRRORS[table]],
+        "topic": int(topic) if topic.isnumeric() else None,
+        "added": row.get("timeadded"),
+    }
+
+
+@dataclass
+class ImportProgress:
+    # dump rows read, including the ones skipped when resuming
+    rows: int
+    # publications written by this run
+    imported: int
+    # rows skipped because a previous run imported them
+    resumed: int
+    bytes_read: int
+    total_bytes: int
+    elapsed: float
+
+    @property
+    def rows_per_s(self) -> float:
+        return (self.rows - self.resumed) / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rows} rows ({self.bytes_read / max(self.total_bytes, 1):.0%} read), "
+            f"{self.imported} publications imported, {self.rows_per_s:.0f} rows/s"
+        )
+
+
+def dump_source(path: str) -> str:
+    # identifies a dump file, a new dump at the same path imports from scratch
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def import_dump(
+    path: str,
+    catalogue: Catalogue,
+    library: str = "libgen",
+    batch_size: int = 5000,
+    *,
+    restart: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+    on_progress: Optional[Callable[[ImportProgress], None]] = None,
+    progress_every: float = 10,
+) -> ImportProgress:
+    """
+    Streams the publications of a dump into the catalogue, written in batches
+    that are checkpointed along with the number of dump rows read.
+
+    :param library: library the publications are imported into, see
+    `TABLE_LIBRARIES`
+    :param restart: import from the start even if a previous run of the same
+    dump was interrupted or finished
+    :param on_progress: called every `progress_every` seconds and once done
+
+    :returns: the final progress
+    """
+    libraries = {table: name.format(library=library) for table, name in TABLE_LIBRARIES.items()}
+    if len(set(libraries.values())) < len(libraries):
+        raise ValueError("Every dump table must be imported into a library of its own.")
+    source = dump_source(path)
+    resume_at, finished = (0, False) if restart else catalogue.get_checkpoint(source)
+    if finished:
+        log.info(f"{path} was already imported, pass restart to import it again.")
+
+    text, raw = open_dump(path)
+    progress = ImportProgress(0, 0, 0, 0, os.fstat(raw.fileno()).st_size, 0.0)
+    start = last_report = perf_counter()
+    # the records of each library waiting to be written
+    batches: Dict[str, List[Dict[str, Any]]] = {name: [] for name in libraries.values()}
+
+    def flush(done: bool = False):
+        # the checkpoint goes along with the last batch, batches written before
+        # it are written again when the import is interrupted in between
+        names = list(batches)
+        for name in names:
+            progress.imported += catalogue.add(
+                name,
+                batches[name],
+                checkpoint=(source, progress.rows, done) if name == names[-1] else None,
+            )
+            batches[name].clear()
+
+    def report():
+        progress.bytes_read = raw.tell()
+        progress.elapsed = perf_counter() - start
+        if on_progress is not None:
+            on_progress(progress)
+
+    with text:
+        if not finished:
+            for table, row in iter_rows(iter_chunks(text, chunk_size)):
+                progress.rows += 1
+                if progress.rows <= resume_at:
+                    progress.resumed += 1
+                    continue
+
+                record = to_record(table, row)
+                if record is not None:
+                    batches[libraries[table]].append(record)
+                # checkpoints every batch_size rows, even from tables that
+                # aren't imported
+                if progress.rows % batch_size == 0:
+                    flush()
+                    if perf_counter() - last_report >= progress_every:
+                        last_report = perf_counter()
+                        report()
+            flush(done=True)
+        report()
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("dump", help="path to a .sql, .sql.gz or .rar dump")
+    parser.add_argument("--catalogue", default="catalogue.db")
+    parser.add_argument(
+        "--library", default="libgen", help="fiction goes to <library>-fiction"
+    )
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints")
+    args = parser.parse_args()
+
+    catalogue = Catalogue(args.catalogue)
+    progress = import_dump(
+        args.dump,
+        catalogue,
+        args.library,
+        args.batch_size,
+        restart=args.restart,
+        chunk_size=args.chunk_size,
+        on_progress=lambda progress: print(progress, flush=True),
+    )
+    print(f"Done in {progress.elapsed:.1f}s.")
+    catalogue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,62 @@
+import asyncio
+import hmac
+import json
 import logging
+import math
+import random
 import aiohttp
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.openapi.utils import get_openapi
 from os import getenv
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import (
+    RedirectResponse,
+    FileResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from dataclasses import replace
 from logging import getLogger
-from typing import Dict, List, Optional
-from misc import cache_cascade, set_cache
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from misc import (
+    ResultCache,
+    cache_backend_from_url,
+    cache_cascade,
+    is_cached,
+    merge_publications,
+    repeat_every,
+    search_cache_key,
+    set_cache,
+    set_cache_backend,
+    touch_cache,
+)
 from exceptions import ErrorJsonResponse
-from models import MetaPublicationModel, LibraryAll, LibraryLibgen, MetaDatadumpModel
+from models import (
+    MetaPublicationModel,
+    MetaFederatedPublicationModel,
+    LibraryAll,
+    LibraryLibgen,
+    MetaDatadumpModel,
+    SearchSource,
+    StreamFormat,
+)
+from catalogue import FICTION_LIBRARY, Catalogue, sync_latest
+from pagination import Paginator, decode_cursor, encode_cursor, result_window
 from fastapi_versioning import VersionedFastAPI
+from starlette.concurrency import run_in_threadpool
 
+from scrapers import ahttp, capture, parsing
 from scrapers.agent import Agent
+from scrapers.breaker import STATE_VALUES, CircuitBreaker, CircuitOpen
+from scrapers.metrics import CONTENT_TYPE, REGISTRY
+from scrapers.tracing import Trace, span, tracing
 from scrapers.planetebooks import PlanetEBooks
 from scrapers.genlibrusec import GenLibRusEc
 from scrapers.libgenlc import LibGenLc
-from scrapers.objects import SearchUrlArgs, SearchMode
+from scrapers.objects import Publication, SearchResult, SearchUrlArgs, SearchMode
 
 FREEBOOKSAPI = VersionedFastAPI(
     docs_url=None, redoc_url=None, prefix_format="/api/v{major}_{minor}"
@@ -32,6 +71,19 @@ def custom_mount(parent: FastAPI, version_key: str):
 FREEBOOKSAPI.new_versioned_mount = custom_mount
 RUNNER_DISHOOK_URL: str = getenv("RUNNER_DISHOOK_URL")  # type: ignore
 
+ahttp.configure_pool(
+    limit=int(getenv("HTTP_POOL_LIMIT", ahttp.POOL_LIMIT)),
+    limit_per_host=int(getenv("HTTP_POOL_LIMIT_PER_HOST", ahttp.POOL_LIMIT_PER_HOST)),
+    ttl_dns_cache=int(getenv("HTTP_DNS_CACHE_TTL", ahttp.DNS_CACHE_TTL)),
+)
+# i.e. sqlite:////data/cache.db or redis://localhost:6379/0 to share
+# topics and datadumps between workers and restarts
+set_cache_backend(cache_backend_from_url(getenv("CACHE_URL", "memory://")))
+parsing.configure_parse_executor(
+    kind=getenv("PARSE_EXECUTOR", "thread"),
+    max_workers=int(getenv("PARSE_WORKERS", 0)) or None,
+)
+
 ##### Logging
 _loggers = ["main", "libgen", "zlibrary"]
 
@@ -47,17 +99,199 @@ log = getLogger("main")
 ##### Logging
 
 
+# "soup" or "lxml", see scrapers.parsing.PARSER_ENGINES
+PARSE_ENGINE = getenv("PARSE_ENGINE", "soup")
+
 LIBRARY_AGENTS: Dict[str, Agent] = {
-    LibraryAll.libgen.value: GenLibRusEc(),
-    LibraryAll.libgenlc.value: LibGenLc(),
-    LibraryAll.planetebooks.value: PlanetEBooks(),
+    LibraryAll.libgen.value: GenLibRusEc(engine=PARSE_ENGINE),
+    LibraryAll.libgenlc.value: LibGenLc(engine=PARSE_ENGINE),
+    LibraryAll.planetebooks.value: PlanetEBooks(engine=PARSE_ENGINE),
+}
+
+# seconds a search result is served from cache for
+SEARCH_CACHE_TTLS: Dict[str, float] = {
+    LibraryAll.libgen.value: float(getenv("SEARCH_CACHE_TTL_LIBGEN", 600)),
+    LibraryAll.libgenlc.value: float(getenv("SEARCH_CACHE_TTL_LIBGENLC", 600)),
+    LibraryAll.planetebooks.value: float(getenv("SEARCH_CACHE_TTL_PLANETEBOOKS", 3600)),
 }
+SEARCH_CACHE = ResultCache(
+    max_entries=int(getenv("SEARCH_CACHE_MAX_ENTRIES", 1024)),
+    max_bytes=int(getenv("SEARCH_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+)
+
+# searches may ask for at most this many publications at once
+MAX_SEARCH_LIMIT = int(getenv("MAX_SEARCH_LIMIT", 500))
+
+# seconds each library gets to answer a search across all libraries
+FEDERATED_SEARCH_TIMEOUTS: Dict[str, float] = {
+    LibraryAll.libgen.value: float(getenv("FEDERATED_TIMEOUT_LIBGEN", 15)),
+    LibraryAll.libgenlc.value: float(getenv("FEDERATED_TIMEOUT_LIBGENLC", 15)),
+    LibraryAll.planetebooks.value: float(getenv("FEDERATED_TIMEOUT_PLANETEBOOKS", 15)),
+}
+
+# catalogue imported from the datadumps with dumpimport.py, answers searches
+# with source=local
+CATALOGUE_PATH = getenv("CATALOGUE_PATH")
+CATALOGUE: Optional[Catalogue] = Catalogue(CATALOGUE_PATH) if CATALOGUE_PATH else None
+# seconds between syncs of the publications the libraries added since, 0
+# disables them
+CATALOGUE_SYNC_EVERY_S = float(getenv("CATALOGUE_SYNC_EVERY_S", 1200))
+# only libraries with sequential publication IDs can be synced, see
+# Agent.sequential_ids
+CATALOGUE_SYNC_LIBRARIES = getenv("CATALOGUE_SYNC_LIBRARIES", "libgen").split(",")
+CATALOGUE_SYNC_MAX_PAGES = int(getenv("CATALOGUE_SYNC_MAX_PAGES", 5))
+
+# opt-in, duplicates searches that are slower than HEDGE_PERCENTILE of recent
+# ones to another alias, for at most HEDGE_BUDGET extra requests per request
+if getenv("HEDGE_REQUESTS", "0") == "1":
+    for agent in LIBRARY_AGENTS.values():
+        agent.hedger = ahttp.Hedger(
+            percentile=float(getenv("HEDGE_PERCENTILE", 95)),
+            budget=float(getenv("HEDGE_BUDGET", 0.1)),
+        )
+
+# requests to a library fail fast after BREAKER_FAILURES consecutive failures
+# until BREAKER_RESET_S seconds have passed, 0 failures disables it
+BREAKER_FAILURES = int(getenv("BREAKER_FAILURES", 5))
+if BREAKER_FAILURES:
+    for library, agent in LIBRARY_AGENTS.items():
+        agent.breaker = CircuitBreaker(
+            library,
+            failure_threshold=BREAKER_FAILURES,
+            reset_timeout=float(getenv("BREAKER_RESET_S", 30)),
+        )
+
+# opt-in, samples raw upstream pages into CAPTURE_DIR laid out like the
+# benchmark fixtures (i.e. CAPTURE_DIR=benchmarks/fixtures)
+CAPTURE_DIR = getenv("CAPTURE_DIR")
+if CAPTURE_DIR:
+    capture.configure_capture(
+        capture.CaptureStore(
+            CAPTURE_DIR,
+            sample_rate=float(getenv("CAPTURE_SAMPLE_RATE", 0.05)),
+            max_pages=int(getenv("CAPTURE_MAX_PAGES", 50)),
+            libraries={
+                type(agent).__name__: library for library, agent in LIBRARY_AGENTS.items()
+            },
+        )
+    )
+
+def library_setting(name: str, library: str, default) -> str:
+    # i.e. UPSTREAM_RATE_LIBGEN, falling back on UPSTREAM_RATE
+    return getenv(f"{name}_{library.upper()}", getenv(name, str(default)))
+
+
+# opt-in, limits of the requests to every alias of a library, requests beyond
+# them are answered with 503 rather than piling up. Unset or a rate of 0 lifts
+# the limits, i.e. UPSTREAM_RATE=5 allows 5 requests per second per alias
+for library, agent in LIBRARY_AGENTS.items():
+    rate = float(library_setting("UPSTREAM_RATE", library, 0))
+    agent.limit_hosts(
+        ahttp.HostLimits(
+            rate=rate,
+            burst=int(library_setting("UPSTREAM_BURST", library, 10)),
+            max_concurrency=int(library_setting("UPSTREAM_MAX_CONCURRENCY", library, 8)),
+            max_queued=int(library_setting("UPSTREAM_MAX_QUEUED", library, 50)),
+            max_wait=float(library_setting("UPSTREAM_MAX_WAIT_S", library, 10)),
+        )
+        if rate > 0
+        else None
+    )
+
+# attempts of a library's topics or datadumps refresh after the first fails,
+# waiting WARM_BACKOFF_S seconds doubled with every attempt in between
+WARM_RETRIES = int(getenv("WARM_RETRIES", 2))
+WARM_BACKOFF_S = float(getenv("WARM_BACKOFF_S", 2))
+
+# seconds between health checks of every library alias, 0 disables them
+ALIAS_HEALTH_CHECK_EVERY_S = float(getenv("ALIAS_HEALTH_CHECK_EVERY_S", 300))
+
+# requests with ?debug=trace (or an X-Debug: trace header) and the
+# X-Debug-Token header set to this return a timeline of where their time went,
+# unset disables tracing
+DEBUG_TOKEN = getenv("DEBUG_TOKEN")
+# OTLP/HTTP endpoint traces are also sent to, i.e. http://localhost:4318/v1/traces
+TRACE_EXPORT_URL = getenv("TRACE_EXPORT_URL")
+_trace_exports = set()
+
+API_IN_FLIGHT = REGISTRY.gauge(
+    "freebooksapi_requests_in_flight", "API requests being served."
+)
+REGISTRY.collected(
+    "freebooksapi_search_cache",
+    "Entries and bytes (stale_ ones being the expired among them), hits, misses "
+    "and evictions of the search result cache.",
+    lambda: (({"stat": stat}, value) for stat, value in SEARCH_CACHE.stats().items()),
+)
+REGISTRY.collected(
+    "freebooksapi_hedger",
+    "Requests, hedged requests and their wins, and the current hedge delay, "
+    "by agent.",
+    lambda: (
+        ({"agent": type(agent).__name__, "stat": stat}, value)
+        for agent in LIBRARY_AGENTS.values()
+        if agent.hedger is not None
+        for stat, value in agent.hedger.stats().items()
+    ),
+)
+REGISTRY.collected(
+    "freebooksapi_circuit_state",
+    "State of the circuit breaker of every library, 0 closed, 1 half-open, 2 open.",
+    lambda: (
+        ({"name": agent.breaker.name}, STATE_VALUES[agent.breaker.state])
+        for agent in LIBRARY_AGENTS.values()
+        if agent.breaker is not None
+    ),
+)
+REGISTRY.collected(
+    "freebooksapi_alias_latency_seconds",
+    "Rolling latency of every library alias.",
+    lambda: (
+        ({"agent": type(agent).__name__, "alias": alias["alias"]}, alias["latency_ms"] / 1000)
+        for agent in LIBRARY_AGENTS.values()
+        for alias in agent.get_alias_pool().summary()
+        if alias["latency_ms"] is not None
+    ),
+)
+REGISTRY.collected(
+    "freebooksapi_alias_error_rate",
+    "Rolling error rate of every library alias.",
+    lambda: (
+        ({"agent": type(agent).__name__, "alias": alias["alias"]}, alias["error_rate"])
+        for agent in LIBRARY_AGENTS.values()
+        for alias in agent.get_alias_pool().summary()
+    ),
+)
+REGISTRY.collected(
+    "freebooksapi_alias_healthy",
+    "Whether every library alias is healthy (1) or not (0).",
+    lambda: (
+        ({"agent": type(agent).__name__, "alias": alias["alias"]}, int(alias["healthy"]))
+        for agent in LIBRARY_AGENTS.values()
+        for alias in agent.get_alias_pool().summary()
+    ),
+)
 
 PERMITTED_FIELDS = "id,authors,isbn,edition,series,title,publisher,year,pages,lang,size,extension,mirrors"
 
 
 @FREEBOOKSAPI.on_event("startup")
 async def startup_event():
+    await ahttp.open_session()
+    if ALIAS_HEALTH_CHECK_EVERY_S:
+        repeat_every(
+            check_aliases,
+            lambda: None,
+            seconds=ALIAS_HEALTH_CHECK_EVERY_S,
+            logger=log,
+        )
+    if CATALOGUE is not None and CATALOGUE_SYNC_EVERY_S:
+        repeat_every(
+            sync_catalogue,
+            lambda: None,
+            seconds=CATALOGUE_SYNC_EVERY_S,
+            logger=log,
+        )
     if RUNNER_DISHOOK_URL is not None:
         async with aiohttp.ClientSession() as session:
             await session.post(
@@ -68,6 +302,25 @@ async def startup_event():
             )
 
 
+async def check_aliases():
+    await asyncio.gather(*(agent.check_aliases() for agent in LIBRARY_AGENTS.values()))
+
+
+async def sync_catalogue():
+    for library in CATALOGUE_SYNC_LIBRARIES:
+        try:
+            added = await sync_latest(
+                CATALOGUE,  # type: ignore
+                library,
+                LIBRARY_AGENTS[library],
+                max_pages=CATALOGUE_SYNC_MAX_PAGES,
+            )
+        except Exception:
+            log.exception(f"Syncing the catalogue with {library} failed.")
+        else:
+            log.info(f"Synced {added} publications of {library} into the catalogue.")
+
+
 @FREEBOOKSAPI.on_event("shutdown")
 async def shutdown_event():
     if RUNNER_DISHOOK_URL is not None:
@@ -78,6 +331,11 @@ async def shutdown_event():
                     "content": "‼️ Heyall <#1032297422975680512> has been shut down 🛑"
                 },
             )
+    await capture.close_capture()
+    await ahttp.close_session()
+    parsing.shutdown_parse_executor()
+    if CATALOGUE is not None:
+        CATALOGUE.close()
 
 
 @FREEBOOKSAPI.get("/", include_in_schema=False)
@@ -85,23 +343,146 @@ def index():
     return RedirectResponse("/home")
 
 
+@FREEBOOKSAPI.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@FREEBOOKSAPI.middleware("http")
+async def track_in_flight(request: Request, call_next):
+    with API_IN_FLIGHT.track_inprogress():
+        return await call_next(request)
+
+
+def wants_trace(request: Request) -> bool:
+    if not DEBUG_TOKEN or "trace" not in (
+        request.query_params.get("debug"),
+        request.headers.get("x-debug"),
+    ):
+        return False
+    return hmac.compare_digest(request.headers.get("x-debug-token", ""), DEBUG_TOKEN)
+
+
+async def export_trace(trace: Trace):
+    try:
+        async with ahttp.get_session().post(
+            TRACE_EXPORT_URL,  # type: ignore
+            json=trace.to_otlp(),
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as resp:
+            if resp.status >= 400:
+                log.warning(f"The trace collector answered with {resp.status}.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        log.warning(f"Exporting trace {trace.trace_id} failed: {exc!r}")
+
+
+@FREEBOOKSAPI.middleware("http")
+async def debug_trace(request: Request, call_next):
+    """
+    Records the spans of a request asking for a trace (see `DEBUG_TOKEN`).
+    JSON objects are returned with the timeline under "trace", every response
+    carries it as a Server-Timing header.
+
+    Only what happens until the response starts is traced, the rest of a
+    streamed response isn't.
+    """
+    if not wants_trace(request):
+        return await call_next(request)
+
+    with tracing() as trace:
+        with span("request", method=request.method, path=request.url.path):
+            response = await call_next(request)
+            if response.headers.get("content-type") == "application/json":
+                body = b"".join([chunk async for chunk in response.body_iterator])  # type: ignore
+
+    headers = {
+        k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")
+    }
+    headers.update({"Server-Timing": trace.server_timing(), "X-Trace-Id": trace.trace_id})
+    if TRACE_EXPORT_URL:
+        task = asyncio.ensure_future(export_trace(trace))
+        _trace_exports.add(task)
+        task.add_done_callback(_trace_exports.discard)
+
+    if response.headers.get("content-type") != "application/json":
+        response.headers.update(headers)
+        return response
+    content = json.loads(body)
+    if isinstance(content, dict):
+        content["trace"] = trace.to_dict()
+    return Response(
+        json.dumps(content),
+        status_code=response.status_code,
+        headers=headers,
+        media_type="application/json",
+    )
+
+
 # /v1/ Routes Below
 
 
-async def cache_get_torrent_datadumps(cache_id: str):
+async def warm_cache(
+    cache_id: str,
+    capability: str,
+    retrieve: Callable[[Agent, bool], Awaitable[Any]],
+):
+    """
+    Fills the cache entry of every library that supports the capability,
+    libraries being retrieved concurrently and retried with backoff on their
+    own, so one failing library doesn't hold up or abort the others.
+
+    :param cache_id: cache ID template, i.e. {library}/topics
+    :param retrieve: retrieves what to cache for an agent, revalidating the
+    page when the second argument is true
+    """
     log.info(f'Retrieving cache information under "{cache_id}"')
-    for name, lib in LIBRARY_AGENTS.items():
+
+    async def warm(name: str, agent: Agent):
         canonical_name = cache_id.format(library=name)
-        dbdumps = await lib.get_datadumps()
+        for attempt in range(WARM_RETRIES + 1):
+            try:
+                value = await retrieve(agent, await is_cached(canonical_name))
+            except ahttp.NotModified:
+                await touch_cache(canonical_name)
+                log.info(f'"{canonical_name}" is unchanged.')
+                return
+            except CircuitOpen as exc:
+                log.warning(f'Not refreshing "{canonical_name}": {exc}')
+                return
+            except Exception:
+                if attempt == WARM_RETRIES:
+                    log.exception(f'Failed to refresh "{canonical_name}".')
+                    return
+                delay = WARM_BACKOFF_S * 2 ** attempt * (0.5 + random.random())
+                log.warning(
+                    f'Refreshing "{canonical_name}" failed, retrying in {delay:.1f}s.'
+                )
+                await asyncio.sleep(delay)
+            else:
+                log.info(f'Filled cache  "{canonical_name}" with "{len(value or [])}" items.')
+                await set_cache(canonical_name, value)
+                return
+
+    await asyncio.gather(
+        *(
+            warm(name, agent)
+            for name, agent in LIBRARY_AGENTS.items()
+            if capability in agent.capabilities()
+        )
+    )
 
-        dumps = {
-            "datadump_url": LIBRARY_AGENTS[name].datadumps_url,
-            "total_results": len(dbdumps),
-            "results": [item.__dict__ for item in dbdumps],
-        }
 
-        log.info(f'Filled cache  "{canonical_name}" with "{len(dumps or [])}" items.')
-        set_cache(canonical_name, dumps)
+async def retrieve_datadumps(agent: Agent, conditional: bool) -> Dict[str, Any]:
+    dbdumps = await agent.get_datadumps(conditional=conditional)
+    return {
+        "datadump_url": agent.datadumps_url,
+        "total_results": len(dbdumps),
+        "results": [item.__dict__ for item in dbdumps],
+    }
+
+
+async def cache_get_torrent_datadumps(cache_id: str):
+    await warm_cache(cache_id, "datadumps", retrieve_datadumps)
 
 
 @FREEBOOKSAPI.get(
@@ -121,12 +502,11 @@ def get_torrent_datadumps(library: LibraryAll):
 
 
 async def cache_get_topics(cache_id: str):
-    log.info(f'Retrieving cache information under "{cache_id}"')
-    for name, lib in LIBRARY_AGENTS.items():
-        canonical_name = cache_id.format(library=name)
-        topics = await lib.get_topics()
-        log.info(f'Filled cache  "{canonical_name}" with "{len(topics or [])}" items.')
-        set_cache(canonical_name, topics)
+    await warm_cache(
+        cache_id,
+        "topics",
+        lambda agent, conditional: agent.get_topics(conditional=conditional),
+    )
 
 
 @FREEBOOKSAPI.get("/{library}/topics", route_version=1, response_model=Dict[str, str])
@@ -157,6 +537,67 @@ def get_torrent_aliases(library: LibraryAll):
     return LIBRARY_AGENTS[library.value].get_aliases()
 
 
+async def search_library(
+    library: str, q: Optional[str], urlargs: SearchUrlArgs
+) -> SearchResult:
+    # a page read in full also answers searches needing only part of it
+    page_key = search_cache_key(library, q, replace(urlargs, needed=None))
+    cache_key = search_cache_key(library, q, urlargs)
+    keys = list(dict.fromkeys((page_key, cache_key)))
+    for key in keys:
+        try:
+            return SEARCH_CACHE.get(key)
+        except KeyError:
+            pass
+    try:
+        result = await LIBRARY_AGENTS[library].search(q, urlargs)
+    except CircuitOpen as exc:
+        return stale_result(keys, exc)
+    found = len(result.publications)
+    # short of what was needed, the page was read to its end
+    complete = found < urlargs.wanted or found >= urlargs.offset + urlargs.limit
+    SEARCH_CACHE.set(
+        page_key if complete else cache_key, result, SEARCH_CACHE_TTLS[library]
+    )
+    return result
+
+
+def stale_result(cache_keys: List[Tuple], error: CircuitOpen) -> SearchResult:
+    # an expired result beats none while the library is down
+    for cache_key in cache_keys:
+        try:
+            return SEARCH_CACHE.get_stale(cache_key)
+        except KeyError:
+            pass
+    raise error from None
+
+
+async def stream_library(
+    library: str, q: Optional[str], urlargs: SearchUrlArgs
+) -> AsyncIterator[Publication]:
+    cache_key = search_cache_key(library, q, urlargs)
+    try:
+        result = SEARCH_CACHE.get(cache_key)
+    except KeyError:
+        try:
+            async for publication in LIBRARY_AGENTS[library].iter_search(q, urlargs):
+                yield publication
+            return
+        except CircuitOpen as exc:
+            # raised before the first publication
+            result = stale_result([cache_key], exc)
+    for publication in result.publications:
+        yield publication
+
+
+# assembles the requested window of publications from cached upstream pages
+PAGINATOR = Paginator(
+    search_library,
+    {library: agent.page_sizes for library, agent in LIBRARY_AGENTS.items()},
+    stream=stream_library,
+)
+
+
 @FREEBOOKSAPI.get(
     "/{library}/search",
     route_version=1,
@@ -172,12 +613,19 @@ async def get_book_or_articles(
     lang: Optional[str] = None,
     page: int = 1,
     search_mode: Optional[SearchMode] = None,
+    source: SearchSource = SearchSource.remote,
+    fiction: bool = False,
 ):
     """
     Retrieve all book, article, and magazine publications through a query.
 
     To get publications under a specific topic, you can specify a valid topic id.
     To get all latest publications, specify search_mode as last.
+    Results are paged by limit, page counts in pages of limit publications
+    and offset skips publications from the start of the page.
+    To search the local catalogue imported from the library's datadumps instead
+    of the library itself, specify source as local, and fiction as true to
+    search the fiction imported from them.
     """
     if q is None and (topic_id is None or search_mode is None):
         return ErrorJsonResponse(
@@ -185,35 +633,249 @@ async def get_book_or_articles(
             "BADARGUMENT",
             f"You cannot use leave the query empty without a topic id or a search mode.",
         )
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        return ErrorJsonResponse(
+            404, "BADARGUMENT", f"The limit must be between 1 and {MAX_SEARCH_LIMIT}."
+        )
 
     agent = LIBRARY_AGENTS[library.value]
-    result = await agent.search(
-        q,
-        SearchUrlArgs(
-            lang=lang,
-            page=page,
-            topic_id=topic_id,
-            limit=limit,
-            offset=offset,
-            search_mode=search_mode,
-        ),
+    urlargs = SearchUrlArgs(
+        lang=lang,
+        page=page,
+        topic_id=topic_id,
+        limit=limit,
+        offset=offset,
+        search_mode=search_mode,
     )
+    if fiction and source != SearchSource.local:
+        return ErrorJsonResponse(
+            404, "BADARGUMENT", "Fiction can only be searched with source local."
+        )
+    if source == SearchSource.local:
+        catalogue_library = (
+            FICTION_LIBRARY.format(library=library.value) if fiction else library.value
+        )
+        if CATALOGUE is None or not await run_in_threadpool(
+            CATALOGUE.has, catalogue_library
+        ):
+            return ErrorJsonResponse(
+                404,
+                "NOTINDEXED",
+                f"There is no local catalogue of {catalogue_library}.",
+            )
+        result = await run_in_threadpool(CATALOGUE.search, catalogue_library, q, urlargs)
+    else:
+        try:
+            result = await PAGINATOR.search(library.value, q, urlargs)
+        except ahttp.UpstreamOverloaded as exc:
+            return ErrorJsonResponse(503, "OVERLOADED", str(exc))
+        except CircuitOpen as exc:
+            response = ErrorJsonResponse(503, "UNAVAILABLE", str(exc))
+            response.headers["Retry-After"] = str(math.ceil(exc.retry_after))
+            return response
     if not result:
         return ErrorJsonResponse(404, "NOTFOUND", f"No publications found under '{q}'.")
 
-    if offset > len(result.publications):
+    start = result_window(urlargs)[0]
+    if start and not result.publications:
         return ErrorJsonResponse(
             404,
             "BADARGUMENT",
-            f"Cannot offset by {offset} with {len(result.publications)} results.",
+            f"Cannot offset by {start} with {result.total_found} results.",
         )
 
     return {
-        "search_url": agent.search_url,
+        "search_url": agent.search_url if source == SearchSource.remote else "local",
         "total_results": result.total_found if result.total_found is not None else None,
         "page_result_range": f"{result.showing_range[0]}-{result.showing_range[1]}/{result.total_found}",
         "page": page,
-        "results": (item.__dict__ for item in result.get_publications(offset, limit)),
+        "results": (item.__dict__ for item in result.publications),
+    }
+
+
+@FREEBOOKSAPI.get(
+    "/{library}/search/stream",
+    route_version=1,
+    response_description="Publications streamed one by one as they are found.",
+    response_class=StreamingResponse,
+)
+async def stream_book_or_articles(
+    library: LibraryAll,
+    q: Optional[str] = None,
+    topic_id: Optional[int] = None,
+    limit: int = 25,
+    offset: int = 0,
+    lang: Optional[str] = None,
+    search_mode: Optional[SearchMode] = None,
+    cursor: Optional[str] = None,
+    format: StreamFormat = StreamFormat.ndjson,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Stream publications as soon as they are parsed, as newline delimited JSON
+    or as server-sent events. Offset skips that many publications.
+
+    Every publication comes with a cursor, pass it as cursor (or, with
+    server-sent events, as the Last-Event-ID header) to resume after that
+    publication. The stream ends with the cursor of the next publications,
+    which is null once there are no more.
+    """
+    cursor = cursor or last_event_id
+    if cursor is not None:
+        try:
+            state = decode_cursor(cursor)
+            if state["library"] != library.value:
+                raise ValueError("The cursor is of another library.")
+            q, topic_id, lang, offset = (
+                state["q"], state["topic_id"], state["lang"], state["position"]
+            )
+            search_mode = state["search_mode"] and SearchMode(state["search_mode"])
+        except (ValueError, KeyError):
+            return ErrorJsonResponse(404, "BADARGUMENT", f"Malformed cursor '{cursor}'.")
+
+    if q is None and (topic_id is None or search_mode is None):
+        return ErrorJsonResponse(
+            404,
+            "BADARGUMENT",
+            f"You cannot use leave the query empty without a topic id or a search mode.",
+        )
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        return ErrorJsonResponse(
+            404, "BADARGUMENT", f"The limit must be between 1 and {MAX_SEARCH_LIMIT}."
+        )
+
+    urlargs = SearchUrlArgs(
+        lang=lang,
+        page=1,
+        topic_id=topic_id,
+        limit=limit,
+        offset=offset,
+        search_mode=search_mode,
+    )
+
+    def cursor_at(position: int) -> str:
+        return encode_cursor(
+            {
+                "library": library.value,
+                "q": q,
+                "topic_id": topic_id,
+                "lang": lang,
+                "search_mode": search_mode and search_mode.value,
+                "position": position,
+            }
+        )
+
+    def event(kind: str, data: dict, event_id: Optional[str] = None) -> str:
+        if format == StreamFormat.sse:
+            head = f"id: {event_id}\n" if event_id else ""
+            return f"{head}event: {kind}\ndata: {json.dumps(data)}\n\n"
+        return json.dumps({kind: data}) + "\n"
+
+    async def events():
+        sent = 0
+        try:
+            async for position, publication in PAGINATOR.iter_window(
+                library.value, q, urlargs, offset, limit
+            ):
+                sent += 1
+                next_cursor = cursor_at(position + 1)
+                yield event(
+                    "publication",
+                    {"cursor": next_cursor, **publication.__dict__},
+                    next_cursor,
+                )
+        except Exception as exc:
+            log.exception(f'Streaming a search of "{library.value}" failed.')
+            yield event("error", {"message": str(exc)})
+            return
+        yield event("end", {"cursor": cursor_at(offset + sent) if sent == limit else None})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if format == StreamFormat.sse else "application/x-ndjson",
+    )
+
+
+@FREEBOOKSAPI.get(
+    "/search",
+    route_version=1,
+    response_description="Merged publications of every library for the given query.",
+    response_model=MetaFederatedPublicationModel,
+)
+async def get_book_or_articles_everywhere(
+    q: str,
+    limit: int = 25,
+    offset: int = 0,
+    lang: Optional[str] = None,
+    page: int = 1,
+    timeout: Optional[float] = None,
+):
+    """
+    Retrieve publications from all libraries at once.
+
+    Libraries are searched concurrently and publications found in several of
+    them (by MD5, or by ISBN and format) are merged. A library that doesn't answer within the
+    timeout (in seconds) is left out and marked as such under `libraries`.
+    """
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        return ErrorJsonResponse(
+            404, "BADARGUMENT", f"The limit must be between 1 and {MAX_SEARCH_LIMIT}."
+        )
+    urlargs = SearchUrlArgs(
+        lang=lang,
+        page=page,
+        topic_id=None,
+        limit=limit,
+        offset=offset,
+        search_mode=None,
+    )
+
+    async def search(library: str):
+        allowed = FEDERATED_SEARCH_TIMEOUTS[library]
+        if timeout is not None:
+            allowed = min(timeout, allowed)
+        start = perf_counter()
+        try:
+            result = await asyncio.wait_for(
+                PAGINATOR.search(library, q, urlargs, prefetch=False), allowed
+            )
+        except asyncio.TimeoutError:
+            status = {
+                "status": "timeout",
+                "message": f"No response within {allowed} seconds.",
+            }
+            result = None
+        except ahttp.UpstreamOverloaded as exc:
+            status = {"status": "overloaded", "message": str(exc)}
+            result = None
+        except CircuitOpen as exc:
+            status = {"status": "unavailable", "message": str(exc)}
+            result = None
+        except Exception as exc:
+            log.exception(f'Searching "{library}" failed.')
+            status = {"status": "error", "message": str(exc)}
+            result = None
+        else:
+            status = {"status": "ok"}
+
+        publications = result.publications if result else []
+        status.update(
+            total_results=result.total_found if result else None,
+            results=len(publications),
+            elapsed_ms=(perf_counter() - start) * 1000,
+        )
+        return publications, status
+
+    outcomes = await asyncio.gather(*(search(library) for library in LIBRARY_AGENTS))
+    merged = merge_publications(
+        {library: pubs for library, (pubs, _) in zip(LIBRARY_AGENTS, outcomes)}
+    )
+    return {
+        "total_results": len(merged),
+        "libraries": {
+            library: status for library, (_, status) in zip(LIBRARY_AGENTS, outcomes)
+        },
+        "results": merged,
     }
 
 
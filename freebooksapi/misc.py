@@ -1,24 +1,55 @@
+import abc
 import asyncio
 import functools
+import json
 import logging
+import pickle
+import re
+import sqlite3
+import threading
 
+from abc import ABC
 from asyncio import create_task, ensure_future
+from collections import OrderedDict
+from dataclasses import astuple
 from logging import getLogger
+from time import monotonic, time
 from traceback import format_exception
-from typing import Any, Callable, Coroutine, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlparse
+from exceptions import ErrorJsonResponse
 from models import LibraryAll
+from scrapers.metrics import REGISTRY
+from scrapers.objects import Publication, SearchUrlArgs
+from scrapers.singleflight import SingleFlight
 from starlette.concurrency import run_in_threadpool
 
 
 log = getLogger("main")
 
+CACHE_REQUESTS = REGISTRY.counter(
+    "freebooksapi_cache_requests_total",
+    "Requests to cached endpoints by whether the entry was fresh, stale or missing.",
+    ("cache", "library", "result"),
+)
+
 NoArgsNoReturnFuncT = Callable[[], None]
 NoArgsNoReturnAsyncFuncT = Callable[[], Coroutine[Any, Any, None]]
 NoArgsNoReturnDecorator = Callable[
     [Union[NoArgsNoReturnFuncT, NoArgsNoReturnAsyncFuncT]], NoArgsNoReturnAsyncFuncT
 ]
 
-MEM_CACHE_DICT = {}
+RE_MD5 = re.compile(r"(?<![0-9a-fA-F])[0-9a-fA-F]{32}(?![0-9a-fA-F])")
 
 
 def repeat_every(
@@ -83,13 +114,373 @@ def repeat_every(
     ensure_future(loop())
 
 
-def set_cache(cache_id: str, value: Any):
-    # just meme cache so far
-    MEM_CACHE_DICT[cache_id] = value
+class CacheBackend(ABC):
+    """
+    Storage behind `set_cache`/`get_cache`. Values must be JSON serializable
+    so that they can be shared between processes.
+
+    Backends are synchronous, the ones that block on disk or network are
+    called in a thread pool so that the event loop isn't held up.
+    """
+
+    # whether calls wait on disk or network
+    blocking = True
+
+    @abc.abstractmethod
+    def get(self, cache_id: str) -> Any:
+        """
+        :raises KeyError: if nothing is cached under `cache_id`
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, cache_id: str, value: Any):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, cache_id: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Per-process cache, nothing is shared between workers or kept on restart.
+    """
+
+    blocking = False
+
+    def __init__(self, store: Optional[Dict[str, Any]] = None) -> None:
+        self.store = {} if store is None else store
+
+    def get(self, cache_id: str) -> Any:
+        return self.store[cache_id]
+
+    def set(self, cache_id: str, value: Any):
+        self.store[cache_id] = value
+
+    def delete(self, cache_id: str):
+        self.store.pop(cache_id, None)
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    On-disk cache shared by every worker on the host and kept across restarts.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        # calls come from the thread pool, one at a time on the connection
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (id TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, cache_id: str) -> Any:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE id = ?", (cache_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(cache_id)
+        return json.loads(row[0])
+
+    def set(self, cache_id: str, value: Any):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (id, value) VALUES (?, ?)",
+                (cache_id, json.dumps(value)),
+            )
+
+    def delete(self, cache_id: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache WHERE id = ?", (cache_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache on a Redis compatible server, shared by every worker that can reach
+    it. Requires the optional `redis` package.
+
+    :param client: client to use instead of connecting to the URL, i.e. a
+    stand-in server
+    """
+
+    def __init__(
+        self, url: str, prefix: str = "freebooksapi:", client: Any = None
+    ) -> None:
+        self.prefix = prefix
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    "The redis cache backend requires the redis package (pip install redis)."
+                ) from None
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, cache_id: str) -> Any:
+        value = self.client.get(self.prefix + cache_id)
+        if value is None:
+            raise KeyError(cache_id)
+        return json.loads(value)
+
+    def set(self, cache_id: str, value: Any):
+        self.client.set(self.prefix + cache_id, json.dumps(value))
+
+    def delete(self, cache_id: str):
+        self.client.delete(self.prefix + cache_id)
+
+    def close(self):
+        self.client.close()
+
+
+def cache_backend_from_url(url: str) -> CacheBackend:
+    """
+    Creates a cache backend from an URL, one of `memory://`,
+    `sqlite:///relative/cache.db`, `sqlite:////absolute/cache.db` or
+    `redis://host:port/db`.
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryCacheBackend()
+    if scheme == "sqlite":
+        if not url.startswith("sqlite:///"):
+            raise ValueError(f"SQLite cache URLs look like sqlite:///path, not '{url}'.")
+        return SqliteCacheBackend(url[len("sqlite:///") :])
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisCacheBackend(url)
+    raise ValueError(f"Unsupported cache backend URL '{url}'.")
+
+
+CACHE_BACKEND: CacheBackend = MemoryCacheBackend()
+
+
+def set_cache_backend(backend: CacheBackend):
+    global CACHE_BACKEND
+    CACHE_BACKEND = backend
+
+
+async def _call_backend(method: str, *args) -> Any:
+    call = getattr(CACHE_BACKEND, method)
+    if CACHE_BACKEND.blocking:
+        return await run_in_threadpool(call, *args)
+    return call(*args)
+
+
+async def set_cache(cache_id: str, value: Any):
+    await _call_backend("set", cache_id, {"value": value, "cached_at": time()})
+
+
+async def get_cache_entry(cache_id: str) -> Tuple[Any, float]:
+    """
+    Returns the cached value along with the UNIX time it was cached at.
+    """
+    entry = await _call_backend("get", cache_id)
+    return entry["value"], entry["cached_at"]
+
+
+async def get_cache(cache_id: str) -> Any:
+    return (await get_cache_entry(cache_id))[0]
+
+
+async def is_cached(cache_id: str) -> bool:
+    try:
+        await _call_backend("get", cache_id)
+    except KeyError:
+        return False
+    return True
+
+
+async def touch_cache(cache_id: str):
+    """
+    Marks the cached value as fresh, i.e. after the source was found to be
+    unchanged. Raises `KeyError` if nothing is cached.
+    """
+    await set_cache(cache_id, await get_cache(cache_id))
+
+
+class ResultCache:
+    """
+    A bounded in-memory cache where entries expire after their TTL and the
+    least recently used ones are evicted once either the entry count or the
+    approximate byte size (measured by pickling the value) runs over.
+
+    Expired entries are kept to be served stale (see `get_stale`) and count
+    towards both bounds, `stats` reports them apart from the fresh ones.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires at, size, value)
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Returns the cached value, raises `KeyError` if it is missing or expired.
+        Expired entries are kept, see `get_stale`, until they are replaced or
+        evicted.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            self.misses += 1
+            raise KeyError(key)
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def get_stale(self, key: Hashable) -> Any:
+        """
+        Returns the cached value even if it expired, i.e. while the source is
+        unavailable. Raises `KeyError` if it is missing.
+        """
+        entry = self._entries[key]
+        self.stale_hits += 1
+        return entry[2]
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        try:
+            size = len(pickle.dumps(value))
+        except Exception:
+            log.warning(f"Could not measure the size of {type(value)}, not caching it.")
+            return
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (monotonic() + ttl, size, value)
+        self.size += size
+
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        now = monotonic()
+        stale = [size for expires, size, _ in self._entries.values() if expires < now]
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "stale_entries": len(stale),
+            "stale_bytes": sum(stale),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
 
+def normalize_query(search_term: Optional[str]) -> Optional[str]:
+    """
+    The query that searches differing only by case or whitespace share.
+    """
+    return " ".join(search_term.split()).casefold() if search_term else None
+
+
+def search_cache_key(
+    library: str, search_term: Optional[str], urlargs: SearchUrlArgs
+) -> Tuple:
+    """
+    Cache key for a search, queries differing only by case or whitespace
+    share an entry.
+    """
+    return (library, normalize_query(search_term), astuple(urlargs))
+
+
+def publication_keys(publication: Publication) -> List[str]:
+    """
+    Identifiers the same file shares across libraries, the MD5s in its mirror
+    links and its ISBNs along with its extension (an ISBN alone stands for the
+    book in every format).
+    """
+    keys = []
+    for mirror in publication.mirrors:
+        match = RE_MD5.search(mirror or "")
+        if match:
+            keys.append(f"md5:{match.group(0).lower()}")
+    extension = (publication.extension or "").strip().lower()
+    if extension:
+        for isbn in publication.isbn or []:
+            digits = re.sub(r"[^0-9Xx]", "", isbn).upper()
+            if len(digits) in (10, 13):
+                keys.append(f"isbn:{digits}:{extension}")
+    return keys
+
+
+def merge_publications(
+    results: Dict[str, List[Publication]]
+) -> List[Dict[str, Any]]:
+    """
+    Merges publications of several libraries in the given order. Publications
+    of different libraries sharing a key (see `publication_keys`), directly or
+    through others, are listed once with the mirrors of all of them and every
+    library they were found in. Publications of the same library are never
+    merged.
+    """
+    found = [(library, pub) for library, pubs in results.items() for pub in pubs]
+    # union-find over the publications, a group is rooted at its first one
+    parent = list(range(len(found)))
+    libraries = [{library} for library, _ in found]
 
-def get_cache(cache_id: str) -> Any:
-    return MEM_CACHE_DICT[cache_id]
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    holders: Dict[str, List[int]] = {}
+    for i, (_, publication) in enumerate(found):
+        for key in publication_keys(publication):
+            for j in holders.setdefault(key, []):
+                first, second = sorted((root(i), root(j)))
+                if first != second and not libraries[first] & libraries[second]:
+                    parent[second] = first
+                    libraries[first] |= libraries[second]
+            holders[key].append(i)
+
+    merged: Dict[int, Dict[str, Any]] = {}
+    for i, (library, publication) in enumerate(found):
+        item = merged.get(root(i))
+        if item is None:
+            item = {**publication.__dict__, "libraries": [library]}
+            item["mirrors"] = list(item["mirrors"])
+            merged[root(i)] = item
+        else:
+            item["mirrors"] += [
+                m for m in publication.mirrors if m not in item["mirrors"]
+            ]
+            item["libraries"].append(library)
+    return list(merged.values())
 
 
 def cache_cascade(
@@ -98,50 +489,98 @@ def cache_cascade(
     stop_cache_after_h: int,
     caching_task: Any,
     pass_result: bool=False,
-    precache: bool=True
+    precache: bool=True,
+    max_stale_wait_s: float=5,
 ):
     """
-    If the end-point is requested, an iterative caching function is invoked
-    in a loop at specific intervals. The cache loop will stop if the endpoint
-    is not hit again after the maximum amount of time to keep re-caching (or)
-    the release time.
-    """
-    cascade_stopped = True
-
-    def cache_cascade():
-        nonlocal cascade_stopped
-        cascade_stopped = False
-
-        def on_end():
-            nonlocal cascade_stopped
-            cascade_stopped = True
-
-        repeat_every(
-            func=functools.partial(caching_task, cache_id),
-            # set released to True after max iter is reached
-            on_end=on_end,
-            seconds=cache_every_h * 60 * 60,
-            raise_exceptions=True,
-            logger=log,
-            max_repetitions=stop_cache_after_h // cache_every_h,
-        )
+    Serves the endpoint from cache with stale-while-revalidate semantics.
+
+    Entries older than `cache_every_h` are still served while the caching task
+    refreshes them in the background. Only a missing entry makes the request
+    wait on the caching task, which concurrent requests share. An entry older
+    than `stop_cache_after_h` is refreshed first, but the request waits at
+    most `max_stale_wait_s` seconds for it before the entry is served as is.
+    If a refresh fails the stale entry keeps being served.
+    """
+    soft_ttl = cache_every_h * 60 * 60
+    hard_ttl = stop_cache_after_h * 60 * 60
+    refreshes = SingleFlight()
+    background = set()
+
+    async def refresh():
+        await refreshes.run(cache_id, functools.partial(caching_task, cache_id))
+
+    def on_background_done(task: asyncio.Task):
+        background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            exc = task.exception()
+            log.error(
+                f'Failed to refresh "{cache_id}", serving stale entries.\n'
+                + "".join(format_exception(type(exc), exc, exc.__traceback__))
+            )
+
+    def refresh_in_background() -> asyncio.Task:
+        # joins the refresh in-flight if there is one
+        task = create_task(refresh())
+        background.add(task)
+        task.add_done_callback(on_background_done)
+        return task
 
     def predicate(func):
         is_coroutine = asyncio.iscoroutinefunction(func)
-        get_cached = lambda library: get_cache(cache_id.format(library=library.value))
+
+        async def get_cached(library: LibraryAll) -> Any:
+            return await get_cache(cache_id.format(library=library.value))
 
         @functools.wraps(func)
         async def wrapped(library: LibraryAll):
-            nonlocal cascade_stopped
-            # cascade starts again when the endpoint is re-hit after stopped
-            if cascade_stopped:
-                cache_cascade()
+            canonical_name = cache_id.format(library=library.value)
+            try:
+                value, cached_at = await get_cache_entry(canonical_name)
+                age = time() - cached_at
+            except KeyError:
+                value = None
+                age = None
+
+            CACHE_REQUESTS.inc(
+                cache=cache_id,
+                library=library.value,
+                result="miss"
+                if age is None or age > hard_ttl
+                else "stale"
+                if age > soft_ttl
+                else "fresh",
+            )
+            refreshed = False
+            if age is None:
+                try:
+                    await refresh()
+                    refreshed = True
+                except Exception:
+                    log.exception(f'Failed to refresh "{canonical_name}".')
+            elif age > hard_ttl:
+                # an upstream that is down mustn't hold every request up
+                task = refresh_in_background()
+                done, _ = await asyncio.wait({task}, timeout=max_stale_wait_s)
+                refreshed = task in done and not task.cancelled() and not task.exception()
+            elif age > soft_ttl:
+                if not len(refreshes):
+                    refresh_in_background()
 
             if pass_result:
                 # here the wrapped function assumes control
                 return await func(library) if is_coroutine else func(library)
 
-            return get_cached(library)
+            if age is None or refreshed:
+                try:
+                    return await get_cached(library)
+                except KeyError:
+                    return ErrorJsonResponse(
+                        503,
+                        "UNAVAILABLE",
+                        f"'{canonical_name}' could not be retrieved at this time.",
+                    )
+            return value
 
         if pass_result:
             # expose cache getter to user's function
@@ -155,7 +594,7 @@ def cache_cascade(
         except RuntimeError:
             log.error("Missing asyncio runtime loop to initiate precaching.")
         else:
-            create_task(caching_task(cache_id))
+            refresh_in_background()
     else:
         raise Exception("It's unsafe to turn off precache at the moment.")
 
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from pydantic import BaseModel
 
@@ -19,6 +19,20 @@ class LibraryAll(str, Enum):
     planetebooks = LibraryPlanetEBooks.planetebooks.value
 
 
+class SearchSource(str, Enum):
+    # scrape the library
+    remote = "remote"
+    # the local catalogue imported from the library's datadumps
+    local = "local"
+
+
+class StreamFormat(str, Enum):
+    # one JSON object per line
+    ndjson = "ndjson"
+    # server-sent events
+    sse = "sse"
+
+
 class DatadumpModel(BaseModel):
     name = "fiction.rar"
     url = "https://libgen.is/dbdumps/fiction.rar"
@@ -62,3 +76,31 @@ class MetaPublicationModel(BaseModel):
     page_result_range = "1-25/779"
     page = 1
     results: List[PublicationModel] = [PublicationModel()]
+
+
+class FederatedPublicationModel(PublicationModel):
+    libraries: List[str] = ["libgen", "libgenlc"]
+
+
+class LibrarySearchStatusModel(BaseModel):
+    status = "ok"
+    total_results: Optional[int] = 779
+    results: int = 25
+    elapsed_ms: float = 812.4
+    message: Optional[str] = None
+
+
+class MetaFederatedPublicationModel(BaseModel):
+    total_results = 1
+    libraries: Dict[str, LibrarySearchStatusModel] = {
+        "libgen": LibrarySearchStatusModel(),
+        "libgenlc": LibrarySearchStatusModel(total_results=312, elapsed_ms=1530.2),
+        "planetebooks": LibrarySearchStatusModel(
+            status="timeout",
+            total_results=None,
+            results=0,
+            elapsed_ms=10000.0,
+            message="No response within 10.0 seconds.",
+        ),
+    }
+    results: List[FederatedPublicationModel] = [FederatedPublicationModel()]
@@ -0,0 +1,265 @@
+import asyncio
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from dataclasses import replace
+from logging import getLogger
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from misc import normalize_query
+from scrapers.objects import Publication, SearchResult, SearchUrlArgs
+
+log = getLogger("pagination")
+
+SearchFunc = Callable[[str, Optional[str], SearchUrlArgs], Awaitable[SearchResult]]
+StreamFunc = Callable[[str, Optional[str], SearchUrlArgs], AsyncIterator[Publication]]
+
+
+def result_window(urlargs: SearchUrlArgs) -> Tuple[int, int]:
+    """
+    The (start, count) of the publications asked for, `page` counting in pages
+    of `limit` publications and `offset` counting from the start of the page.
+    """
+    return (urlargs.page - 1) * urlargs.limit + urlargs.offset, urlargs.limit
+
+
+def choose_page_size(page_sizes: Sequence[int], start: int, count: int) -> int:
+    """
+    The upstream page size that spans the window of `count` publications from
+    `start` on with the fewest pages, the smallest one among those. Small
+    windows are fetched as small pages rather than the largest the library
+    has, and are read no further than they need.
+    """
+
+    def cost(page_size: int) -> Tuple[int, int]:
+        pages = (start + max(count, 1) - 1) // page_size - start // page_size + 1
+        return pages, page_size
+
+    return min(page_sizes, key=cost)
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    """
+    Opaque token of a query and a position in its results, to resume from.
+    """
+    data = json.dumps(state, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """
+    :raises ValueError: if the cursor wasn't made by `encode_cursor`
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError(f"Malformed cursor '{cursor}'.") from None
+    if not isinstance(state, dict):
+        raise ValueError(f"Malformed cursor '{cursor}'.")
+    return state
+
+
+class Paginator:
+    """
+    Serves any window of search results by fetching the upstream pages it spans
+    concurrently, the upstream page size being chosen for the window (see
+    `choose_page_size`) rather than being the limit asked for. Pages are
+    fetched through `search`, which caches them per query.
+
+    When a client walks the results sequentially, asking for the window that
+    starts where its last one ended, the upstream page its next window needs
+    is fetched in the background ahead of the request.
+
+    :param search: searches a library for one upstream page
+    :param page_sizes: publications per upstream page each library can be
+    asked for, libraries without any are searched with the limit and offset
+    as is
+    :param max_tracked: number of queries whose position is remembered
+    :param stream: yields the publications of one upstream page as they are
+    parsed, used by `iter_window`
+    """
+
+    def __init__(
+        self,
+        search: SearchFunc,
+        page_sizes: Dict[str, Sequence[int]],
+        max_tracked: int = 1024,
+        stream: Optional[StreamFunc] = None,
+    ) -> None:
+        self.search_page = search
+        self.stream_page = stream
+        self.page_sizes = page_sizes
+        self.max_tracked = max_tracked
+        # query -> where the last window of it ended
+        self._positions: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._prefetches: Set[asyncio.Task] = set()
+
+    async def search(
+        self,
+        library: str,
+        search_term: Optional[str],
+        urlargs: SearchUrlArgs,
+        prefetch: bool = True,
+    ) -> SearchResult:
+        """
+        :param prefetch: whether a client walking the results gets its next
+        window fetched ahead, searches that aren't walked (i.e. across all
+        libraries) shouldn't
+        :returns: :class:`SearchResult` holding exactly the publications of the
+        requested window
+        """
+        if not self.page_sizes.get(library):
+            result = await self.search_page(library, search_term, urlargs)
+            return replace(
+                result, publications=result.get_publications(urlargs.offset, urlargs.limit)
+            )
+
+        start, count = result_window(urlargs)
+        page_size = choose_page_size(self.page_sizes[library], start, count)
+        first, last = start // page_size, (start + count - 1) // page_size
+        # the last page is needed up to the end of the window only
+        needed = start + count - last * page_size
+        pages = await asyncio.gather(
+            *(
+                self.search_page(
+                    library,
+                    search_term,
+                    self._page_args(
+                        urlargs, page, page_size, needed if page == last else None
+                    ),
+                )
+                for page in range(first, last + 1)
+            )
+        )
+        publications = [pub for page in pages for pub in page.publications]
+        skip = start - first * page_size
+        window = publications[skip : skip + count]
+        total = pages[0].total_found
+
+        if prefetch and self._is_walking(
+            library, search_term, urlargs, start, start + count
+        ):
+            self._prefetch(
+                library, search_term, urlargs, start + count, total, page_size, last
+            )
+
+        return SearchResult(window, total, (start + 1, start + len(window)))
+
+    async def iter_window(
+        self,
+        library: str,
+        search_term: Optional[str],
+        urlargs: SearchUrlArgs,
+        start: int,
+        count: int,
+    ) -> AsyncIterator[Tuple[int, Publication]]:
+        """
+        Yields (position, publication) for the `count` publications from
+        `start` on as they are parsed, upstream pages being streamed one after
+        the other.
+        """
+        assert self.stream_page is not None
+        page_sizes = self.page_sizes.get(library)
+        page_size = choose_page_size(page_sizes, start, count) if page_sizes else None
+        # libraries without a page size have all their results on one page
+        page = start // page_size if page_size else 0
+        position = page * page_size if page_size else 0
+        while position < start + count:
+            page_args = (
+                self._page_args(urlargs, page, page_size) if page_size else urlargs
+            )
+            publications = self.stream_page(library, search_term, page_args)
+            page_end = position + (page_size or 0)
+            try:
+                async for publication in publications:
+                    if position >= start:
+                        yield position, publication
+                    position += 1
+                    if position >= start + count:
+                        return
+            finally:
+                await publications.aclose()  # type: ignore
+            if position < page_end or not page_size:
+                # the last page
+                return
+            page += 1
+
+    def _is_walking(
+        self,
+        library: str,
+        search_term: Optional[str],
+        urlargs: SearchUrlArgs,
+        start: int,
+        end: int,
+    ) -> bool:
+        # continuing where the last window ended
+        key = (
+            library,
+            normalize_query(search_term),
+            urlargs.lang,
+            urlargs.topic_id,
+            urlargs.search_mode,
+        )
+        walking = self._positions.get(key) == start
+        self._positions[key] = end
+        self._positions.move_to_end(key)
+        while len(self._positions) > self.max_tracked:
+            self._positions.popitem(last=False)
+        return walking
+
+    def _prefetch(
+        self,
+        library: str,
+        search_term: Optional[str],
+        urlargs: SearchUrlArgs,
+        next_start: int,
+        total: Optional[int],
+        fetched_page_size: int,
+        fetched_up_to: int,
+    ):
+        page_size = choose_page_size(self.page_sizes[library], next_start, urlargs.limit)
+        first = next_start // page_size
+        if page_size == fetched_page_size:
+            first = max(first, fetched_up_to + 1)
+        last = (next_start + urlargs.limit - 1) // page_size
+        if isinstance(total, int):
+            last = min(last, (total - 1) // page_size)
+
+        pages: List[int] = list(range(first, last + 1))
+        for page in pages:
+            task = asyncio.ensure_future(
+                self.search_page(library, search_term, self._page_args(urlargs, page, page_size))
+            )
+            self._prefetches.add(task)
+            task.add_done_callback(self._prefetched)
+
+    def _prefetched(self, task: asyncio.Task):
+        self._prefetches.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning(f"Prefetching a search page failed: {task.exception()!r}")
+
+    @staticmethod
+    def _page_args(
+        urlargs: SearchUrlArgs, page: int, page_size: int, needed: Optional[int] = None
+    ) -> SearchUrlArgs:
+        # page counts from 0 here and from 1 upstream
+        return replace(
+            urlargs,
+            page=page + 1,
+            limit=page_size,
+            offset=0,
+            needed=needed if needed is not None and needed < page_size else None,
+        )
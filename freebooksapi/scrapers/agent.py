@@ -1,16 +1,68 @@
 import abc
+import asyncio
 from abc import ABC
+from contextlib import contextmanager
+from functools import partial
 from logging import getLogger
-from typing import Any, Dict, List, Optional
-from asyncio import iscoroutinefunction
+from time import monotonic
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+import aiohttp
 
 from bs4 import BeautifulSoup, SoupStrainer
+from lxml.html import HtmlElement
 
-from .ahttp import get_page
-from .objects import Datadump, SearchResult, SearchUrlArgs
+from .ahttp import (
+    Hedger,
+    HostLimits,
+    NotModified,
+    UpstreamOverloaded,
+    UpstreamStatusError,
+    forget_validators,
+    get_page,
+    limit_host,
+)
+from .aliases import AliasPool
+from .breaker import CircuitBreaker
+from .capture import capture_page, capturing
+from .metrics import REGISTRY
+from .objects import Datadump, Publication, SearchResult, SearchUrlArgs
+from .parsing import PARSER_ENGINES, run_parser
+from .singleflight import SingleFlight
+from .tracing import span
 
 log = getLogger("agent")
 
+T = TypeVar("T")
+
+# operations an agent may support, see `Agent.capabilities`
+CAPABILITIES = ("search", "topics", "datadumps", "sync")
+
+# errors after which a request is retried on another alias
+FAILOVER_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, UpstreamStatusError)
+
+ALIAS_FAILURES = REGISTRY.counter(
+    "freebooksapi_alias_failures_total",
+    "Requests to an alias that failed and were retried or hedged elsewhere.",
+    ("agent", "alias"),
+)
+OPERATION_ERRORS = REGISTRY.counter(
+    "freebooksapi_agent_errors_total",
+    "Searches, topics and datadumps retrievals that failed, by agent.",
+    ("agent", "operation"),
+)
+
 
 class Agent(ABC):
     """
@@ -18,6 +70,13 @@ class Agent(ABC):
     operations like searching a book and parses out the data into Python objects.
     """
 
+    # publications per search page the library can be asked for, empty if the
+    # page size can't be chosen
+    page_sizes: Tuple[int, ...] = ()
+    # whether publication IDs grow with every publication the library adds,
+    # which syncing the catalogue with its last added pages relies on
+    sequential_ids = False
+
     def __init__(
         self,
         search_url: str,
@@ -26,14 +85,208 @@ class Agent(ABC):
         *,
         search_strain: Optional[SoupStrainer] = None,
         topics_strain: Optional[SoupStrainer] = None,
-        datadumps_strain: Optional[SoupStrainer] = None
+        datadumps_strain: Optional[SoupStrainer] = None,
+        engine: str = "soup",
+        attempt_timeout: float = 20,
+        max_attempts: int = 3,
+        hedger: Optional[Hedger] = None,
+        breaker: Optional[CircuitBreaker] = None
     ) -> None:
+        if engine not in PARSER_ENGINES:
+            raise ValueError(f"Parser engine must be one of {PARSER_ENGINES}, not '{engine}'.")
+        self.engine = engine
         self.search_url = search_url
         self.topics_url = topics_url
         self.datadumps_url = datadumps_url
         self.search_strain = search_strain
         self.topics_strain = topics_strain
         self.datadumps_strain = datadumps_strain
+        # when the library has aliases, each attempt may take this many
+        # seconds before the request is retried on the next alias
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        # opt-in, duplicates slow requests to the next alias
+        self.hedger = hedger
+        # opt-in, fails requests fast while the library is down
+        self.breaker = breaker
+        # concurrent identical fetches share one upstream request
+        self._inflight = SingleFlight()
+        self._alias_pool: Optional[AliasPool] = None
+
+    def __getstate__(self):
+        # agents are shipped to the parse pool when it is a process pool,
+        # runtime state (locks, semaphores...) is kept in underscored attributes
+        # and doesn't travel along
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    async def fetch_parsed(
+        self,
+        url: str,
+        parser: str,
+        strain: Optional[SoupStrainer] = None,
+        conditional: bool = False,
+    ) -> Any:
+        """
+        Retrieves the page and parses it with the named parse method in the
+        parse pool.
+
+        :param url: page URL
+        :param parser: name of the parse method, i.e. `parse_result`
+        :param strain: strainer to build the soup with
+        :param conditional: revalidate the page retrieved last time with this
+        flag, an unchanged page isn't parsed again
+
+        :returns: whatever the parse method returns
+
+        :raises NotModified: if `conditional` and the page is unchanged
+        """
+        async def fetch():
+            fetched = []
+
+            def fetch_page(target: str, timeout: Optional[aiohttp.ClientTimeout]):
+                fetched.append(target)
+                return get_page(target, timeout=timeout, conditional=conditional)
+
+            content = await self.with_failover(url, fetch_page)
+            if capturing():
+                capture_page(self, parser, url, content)
+            try:
+                return await run_parser(self, parser, content, strain)
+            except BaseException:
+                # the page must be parsed again next time even if unchanged
+                for target in fetched:
+                    forget_validators(target)
+                raise
+
+        return await self._inflight.run(("page", url, parser, conditional), fetch)
+
+    def capabilities(self) -> FrozenSet[str]:
+        """
+        The operations the library supports out of `CAPABILITIES`, topics and
+        datadumps being supported when their URL is set and catalogue syncs
+        when its IDs are sequential.
+        """
+        supported = {"search"}
+        if self.topics_url:
+            supported.add("topics")
+        if self.datadumps_url:
+            supported.add("datadumps")
+        if self.sequential_ids:
+            supported.add("sync")
+        return frozenset(supported)
+
+    def get_alias_pool(self) -> AliasPool:
+        """
+        The pool of the search URL's host and the library's aliases, created
+        on first use.
+        """
+        if self._alias_pool is None:
+            try:
+                aliases = self.get_aliases()
+            except NotImplementedError:
+                aliases = []
+            self._alias_pool = AliasPool([self.search_url, *aliases])
+        return self._alias_pool
+
+    @contextmanager
+    def count_errors(self, operation: str):
+        try:
+            yield
+        except (asyncio.CancelledError, NotModified):
+            raise
+        except Exception:
+            OPERATION_ERRORS.inc(agent=type(self).__name__, operation=operation)
+            raise
+
+    def limit_hosts(self, limits: Optional[HostLimits]):
+        """
+        Limits the requests to every alias of the library, each alias on its
+        own. None lifts the limits.
+        """
+        pool = self.get_alias_pool()
+        for base in pool.bases:
+            limit_host(pool.host(base), limits)
+
+    async def check_aliases(self):
+        pool = self.get_alias_pool()
+        if len(pool.bases) > 1:
+            await pool.health_check()
+
+    async def with_failover(
+        self,
+        url: str,
+        fetch: Callable[[str, Optional[aiohttp.ClientTimeout]], Awaitable[T]],
+    ) -> T:
+        """
+        Calls `fetch` with the URL pointed at the best alias of the library,
+        retrying on the next one if the request fails or times out. With a
+        hedger, slow attempts are also duplicated to the next alias. URLs on
+        hosts outside the alias pool are fetched as is.
+
+        :param url: URL on any of the library's aliases
+        :param fetch: called with the URL to request and the timeout to use
+
+        :returns: whatever `fetch` returns
+
+        :raises CircuitOpen: if the library is failing and has a breaker
+        """
+        if self.breaker is None:
+            return await self._failover(url, fetch)
+        with self.breaker.guard(FAILOVER_ERRORS, (NotModified,)):
+            return await self._failover(url, fetch)
+
+    async def _failover(
+        self,
+        url: str,
+        fetch: Callable[[str, Optional[aiohttp.ClientTimeout]], Awaitable[T]],
+    ) -> T:
+        pool = self.get_alias_pool()
+        candidates = pool.candidates()[: self.max_attempts] if pool.owns(url) else []
+        if len(candidates) < 2:
+            return await fetch(url, None)
+
+        timeout = aiohttp.ClientTimeout(total=self.attempt_timeout)
+        failed = set()
+
+        async def attempt(base: str) -> T:
+            start = monotonic()
+            try:
+                outcome = await fetch(pool.rewrite(url, base), timeout)
+            except NotModified:
+                pool.record_success(base, monotonic() - start)
+                raise
+            except UpstreamOverloaded:
+                # our own limit, the alias itself is fine
+                failed.add(base)
+                raise
+            except FAILOVER_ERRORS:
+                pool.record_failure(base)
+                ALIAS_FAILURES.inc(agent=type(self).__name__, alias=base)
+                failed.add(base)
+                raise
+            pool.record_success(base, monotonic() - start)
+            return outcome
+
+        error: Optional[BaseException] = None
+        for base in candidates:
+            if base in failed:
+                continue
+            backups = [other for other in candidates if other not in failed | {base}]
+            try:
+                if self.hedger is not None and backups:
+                    return await self.hedger.run(
+                        partial(attempt, base), partial(attempt, backups[0])
+                    )
+                return await attempt(base)
+            except (*FAILOVER_ERRORS, UpstreamOverloaded) as exc:
+                error = exc
+                if len(failed) < len(candidates):
+                    log.warning(f"{base} failed ({exc!r}), retrying on another alias.")
+        assert error is not None
+        raise error
 
     async def search(self, search_term: Optional[str], urlargs: SearchUrlArgs):
         """
@@ -49,13 +302,54 @@ class Agent(ABC):
             raise ValueError("Your search term must be at least 3 characters long.")
 
         page_url = self.get_search_url(search_term, urlargs)
-        print(f"GETing '{page_url}' for the ")
-        page = await get_page(page_url, self.search_strain)
-        return (
-            await self.parse_result(page)
-            if iscoroutinefunction(self.parse_result)
-            else self.parse_result(page)
-        )
+        with self.count_errors("search"), span(
+            "agent.search", agent=type(self).__name__, url=page_url
+        ):
+            return await self._inflight.run(
+                # results may be cut short after the requested publications
+                ("search", page_url, urlargs.wanted),
+                lambda: self.fetch_result(page_url, urlargs),
+            )
+
+    async def iter_search(
+        self, search_term: Optional[str], urlargs: SearchUrlArgs
+    ) -> AsyncIterator[Publication]:
+        """
+        Yields the publications of the search page in order, as soon as each
+        is available. Agents that can't parse the page incrementally yield
+        them once the page is complete.
+
+        :param search_term: text query
+        :param urlargs: other url arguments
+        """
+        result = await self.search(search_term, urlargs)
+        for publication in result.publications:
+            yield publication
+
+    async def fetch_result(self, page_url: str, urlargs: SearchUrlArgs) -> SearchResult:
+        """
+        Retrieves and parses the search page. Agents that are able to parse
+        the page as it streams in may stop reading once `urlargs.wanted`
+        publications are found.
+
+        :param page_url: URL encoded with the search term and url args
+        :param urlargs: url arguments the URL was encoded with
+
+        :returns: :class:`SearchResult`
+        """
+        result = await self.fetch_parsed(page_url, "parse_result", self.search_strain)
+        return await self.complete_result(result)
+
+    async def complete_result(self, result: SearchResult) -> SearchResult:
+        """
+        Fills in anything the search page alone doesn't provide, i.e. by
+        following links to detail pages. Returns the result as is by default.
+
+        :param result: the parsed search page
+
+        :returns: :class:`SearchResult`
+        """
+        return result
 
     def get_aliases(self):
         """
@@ -65,17 +359,27 @@ class Agent(ABC):
         """
         raise NotImplementedError
 
-    async def get_topics(self):
+    async def get_topics(self, conditional: bool = False):
+        """
+        :param conditional: see `fetch_parsed`
+        """
         if not self.topics_url:
             raise NotImplementedError
-        return self.parse_topics(await get_page(self.topics_url, self.topics_strain))
+        with self.count_errors("topics"):
+            return await self.fetch_parsed(
+                self.topics_url, "parse_topics", self.topics_strain, conditional
+            )
 
-    async def get_datadumps(self):
+    async def get_datadumps(self, conditional: bool = False):
+        """
+        :param conditional: see `fetch_parsed`
+        """
         if not self.datadumps_url:
             raise NotImplementedError
-        return self.parse_datadumps(
-            await get_page(self.datadumps_url, self.datadumps_strain)
-        )
+        with self.count_errors("datadumps"):
+            return await self.fetch_parsed(
+                self.datadumps_url, "parse_datadumps", self.datadumps_strain, conditional
+            )
 
     @abc.abstractmethod
     def get_search_url(self, search_term: Optional[str], urlargs: SearchUrlArgs) -> str:
@@ -118,3 +422,15 @@ class Agent(ABC):
         :returns: :class:`LastAddedResult`
         """
         raise NotImplementedError
+
+    # The lxml engine counterparts, these take the raw lxml tree of the page
+    # and must return exactly what their BeautifulSoup counterparts do.
+
+    def parse_topics_lxml(self, page: HtmlElement) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def parse_result_lxml(self, page: HtmlElement) -> SearchResult:
+        raise NotImplementedError
+
+    def parse_datadumps_lxml(self, page: HtmlElement) -> List[Datadump]:
+        raise NotImplementedError
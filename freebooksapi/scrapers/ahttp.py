@@ -1,8 +1,18 @@
 import asyncio
+import codecs
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass
 from logging import getLogger
+from time import monotonic
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, TypeVar
+from urllib.parse import urlsplit
 
 import aiohttp
-from bs4 import BeautifulSoup as soup
+
+from .metrics import REGISTRY, SIZE_BUCKETS
+from .tracing import current_trace, record_span, span, trace_config
 
 logger = getLogger("http")
 
@@ -11,29 +21,563 @@ HEAD = {
 }
 TIMEOUT = aiohttp.ClientTimeout(total=90, connect=0, sock_connect=60, sock_read=90)
 
+# connection pool settings for the shared session, see `configure_pool`
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 20
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+CHUNK_SIZE = 16 * 1024
+
+_pool_settings = {
+    "limit": POOL_LIMIT,
+    "limit_per_host": POOL_LIMIT_PER_HOST,
+    "ttl_dns_cache": DNS_CACHE_TTL,
+    "keepalive_timeout": KEEPALIVE_TIMEOUT,
+}
+_session: Optional[aiohttp.ClientSession] = None
+# validators of the pages retrieved with `conditional`, at most MAX_VALIDATORS
+MAX_VALIDATORS = 1024
+_validators: "OrderedDict[str, Validators]" = OrderedDict()
+# see `limit_host`, limiters are created on first use within the running loop
+_host_limits: Dict[str, "HostLimits"] = {}
+_limiters: Dict[str, "HostLimiter"] = {}
+
+T = TypeVar("T")
+
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "freebooksapi_upstream_request_seconds",
+    "Time until an upstream page is fully read, by host and status.",
+    ("host", "status"),
+)
+UPSTREAM_BYTES = REGISTRY.histogram(
+    "freebooksapi_upstream_response_bytes",
+    "Size of the upstream pages read, by host.",
+    ("host",),
+    buckets=SIZE_BUCKETS,
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "freebooksapi_upstream_errors_total",
+    "Upstream requests that failed, by host and error.",
+    ("host", "error"),
+)
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    "freebooksapi_upstream_requests_in_flight",
+    "Upstream requests being made, by host.",
+    ("host",),
+)
+UPSTREAM_QUEUED = REGISTRY.gauge(
+    "freebooksapi_upstream_requests_queued",
+    "Upstream requests waiting on the limits of their host.",
+    ("host",),
+)
+UPSTREAM_WAIT_SECONDS = REGISTRY.histogram(
+    "freebooksapi_upstream_wait_seconds",
+    "Time upstream requests waited on the limits of their host.",
+    ("host",),
+)
+UPSTREAM_SHED = REGISTRY.counter(
+    "freebooksapi_upstream_shed_total",
+    "Upstream requests refused by the limits of their host, by reason.",
+    ("host", "reason"),
+)
+
 
 class LoopError(Exception):
     def __init__(self, *a) -> None:
         pass
 
 
-async def get(url, jar=None, proxy_list=None):
+def configure_pool(
+    limit: int = POOL_LIMIT,
+    limit_per_host: int = POOL_LIMIT_PER_HOST,
+    ttl_dns_cache: int = DNS_CACHE_TTL,
+    keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+):
+    """
+    Sets the connection pool limits used when the shared session is created.
+    Takes effect for the next session opened.
+    """
+    _pool_settings.update(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=ttl_dns_cache,
+        keepalive_timeout=keepalive_timeout,
+    )
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the process-wide session every scraper request goes through.
+    Connections are kept alive and pooled per host, and DNS lookups are cached.
+
+    The session is opened lazily so precaching tasks that start before the
+    application startup event share it as well.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=_pool_settings["limit"],
+            limit_per_host=_pool_settings["limit_per_host"],
+            ttl_dns_cache=_pool_settings["ttl_dns_cache"],
+            use_dns_cache=True,
+            keepalive_timeout=_pool_settings["keepalive_timeout"],
+        )
+        _session = aiohttp.ClientSession(
+            headers=HEAD,
+            timeout=TIMEOUT,
+            connector=connector,
+            trace_configs=[trace_config()],
+        )
+    return _session
+
+
+async def open_session() -> aiohttp.ClientSession:
+    return get_session()
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class UpstreamStatusError(Exception):
+    """The library answered with a server error."""
+
+    def __init__(self, url: str, status: int) -> None:
+        self.url = url
+        self.status = status
+        super().__init__(f"GET {url} answered with {status}.")
+
+
+class NotModified(Exception):
+    """The page is unchanged since it was last retrieved with `conditional`."""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        super().__init__(f"{url} is unchanged.")
+
+
+@dataclass
+class Validators:
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # hash of the body, for libraries that send neither of the above
+    digest: Optional[str] = None
+
+
+def conditional_headers(url: str) -> Dict[str, str]:
+    validators = _validators.get(url)
+    headers = {}
+    if validators is not None:
+        if validators.etag:
+            headers["If-None-Match"] = validators.etag
+        if validators.last_modified:
+            headers["If-Modified-Since"] = validators.last_modified
+    return headers
+
+
+def store_validators(url: str, resp: aiohttp.ClientResponse, body: bytes) -> bool:
+    """
+    Remembers the validators of the response.
+
+    :returns: whether the body is the same as the last time
+    """
+    digest = hashlib.sha256(body).hexdigest()
+    previous = _validators.get(url)
+    _validators[url] = Validators(
+        resp.headers.get("ETag"), resp.headers.get("Last-Modified"), digest
+    )
+    _validators.move_to_end(url)
+    while len(_validators) > MAX_VALIDATORS:
+        _validators.popitem(last=False)
+    return previous is not None and previous.digest == digest
+
+
+def forget_validators(url: str):
+    """
+    Makes the next conditional request of the URL retrieve the page in full,
+    i.e. when what was made of the last one was lost.
+    """
+    _validators.pop(url, None)
+
+
+def timeout_kwargs(timeout: Optional[aiohttp.ClientTimeout]) -> dict:
+    # aiohttp treats an explicit None as no timeout at all, leave it out so
+    # that the session default applies
+    return {} if timeout is None else {"timeout": timeout}
+
+
+def check_status(url: str, resp: aiohttp.ClientResponse):
+    if resp.status >= 500:
+        raise UpstreamStatusError(url, resp.status)
+
+
+# Cancellations (client disconnects, timeouts) propagate as is so that callers
+# awaiting with a timeout or sharing a request can tell them apart from errors.
+
+
+@contextmanager
+def track_request(url: str):
+    """
+    Records the duration, outcome and size of an upstream request, the body
+    sets "status" and adds to "bytes" of the yielded dictionary.
+    """
+    host = urlsplit(url).netloc
+    outcome = {"status": "error", "bytes": 0}
+    start = monotonic()
+    UPSTREAM_IN_FLIGHT.inc(host=host)
     try:
+        yield outcome
+    except asyncio.CancelledError:
+        outcome["status"] = "cancelled"
+        raise
+    except NotModified:
+        raise
+    except Exception as exc:
+        UPSTREAM_ERRORS.inc(host=host, error=type(exc).__name__)
+        raise
+    else:
+        UPSTREAM_BYTES.observe(outcome["bytes"], host=host)
+    finally:
+        UPSTREAM_IN_FLIGHT.dec(host=host)
+        UPSTREAM_SECONDS.observe(monotonic() - start, host=host, status=outcome["status"])
+
+
+async def _read(
+    url: str, resp: aiohttp.ClientResponse, outcome: dict, conditional: bool = False
+) -> str:
+    outcome["status"] = str(resp.status)
+    check_status(url, resp)
+    if conditional and resp.status == 304:
+        raise NotModified(url)
+    with span("http.body") as body:
+        content = await resp.read()
+        outcome["bytes"] = len(content)
+        if body is not None:
+            body.attributes["bytes"] = outcome["bytes"]
+    if conditional and resp.status == 200 and store_validators(url, resp, content):
+        raise NotModified(url)
+    return await resp.text()
+
+
+class UpstreamOverloaded(Exception):
+    """The host's limits are exhausted, the request was shed without being sent."""
+
+    def __init__(self, host: str, reason: str) -> None:
+        self.host = host
+        self.reason = reason
+        super().__init__(f"Too many requests to {host} ({reason}), try again later.")
+
+
+@dataclass
+class HostLimits:
+    # requests per second and how many may be sent at once above that rate
+    rate: float = 5
+    burst: int = 10
+    # requests in flight at once
+    max_concurrency: int = 8
+    # requests waiting for their turn, beyond it requests are shed
+    max_queued: int = 50
+    # seconds a request may wait for its turn before it is shed
+    max_wait: float = 10
+
+
+class HostLimiter:
+    """
+    Token bucket rate limit and concurrency limit of the requests to a host.
+    Requests wait for their turn in order, they are shed with
+    :class:`UpstreamOverloaded` rather than queued when too many are waiting
+    or their turn wouldn't come within `max_wait`.
+    """
+
+    def __init__(self, host: str, limits: HostLimits) -> None:
+        self.host = host
+        self.limits = limits
+        self.tokens = float(limits.burst)
+        self.waiting = 0
+        self._updated = monotonic()
+        self._semaphore = asyncio.Semaphore(limits.max_concurrency)
+
+    def _reserve(self, within: float) -> Optional[float]:
+        # takes a token, possibly one refilled later, returns how long to wait
+        # for it or None if it won't be there in time
+        now = monotonic()
+        self.tokens = min(
+            self.limits.burst, self.tokens + (now - self._updated) * self.limits.rate
+        )
+        self._updated = now
+        delay = max(0.0, (1 - self.tokens) / self.limits.rate)
+        if delay > within:
+            return None
+        self.tokens -= 1
+        return delay
+
+    def _shed(self, reason: str) -> UpstreamOverloaded:
+        UPSTREAM_SHED.inc(host=self.host, reason=reason)
+        return UpstreamOverloaded(self.host, reason)
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.waiting >= self.limits.max_queued:
+            raise self._shed("queue full")
+
+        start = monotonic()
+        self.waiting += 1
+        UPSTREAM_QUEUED.inc(host=self.host)
+        acquire = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=self.limits.max_wait)
+            if not acquire.done():
+                raise self._shed("concurrency")
+            delay = self._reserve(self.limits.max_wait - (monotonic() - start))
+            if delay is None:
+                raise self._shed("rate")
+            await asyncio.sleep(delay)
+        except BaseException:
+            if not acquire.cancel() and not acquire.cancelled() and acquire.exception() is None:
+                self._semaphore.release()
+            raise
+        finally:
+            self.waiting -= 1
+            UPSTREAM_QUEUED.dec(host=self.host)
+        UPSTREAM_WAIT_SECONDS.observe(monotonic() - start, host=self.host)
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+def limit_host(host: str, limits: Optional[HostLimits]):
+    """
+    Sets the limits of the requests to the host (i.e. libgen.rs), None lifts
+    them. Hosts without limits are requested as fast as asked.
+    """
+    _limiters.pop(host, None)
+    if limits is None:
+        _host_limits.pop(host, None)
+    else:
+        _host_limits[host] = limits
+
+
+@asynccontextmanager
+async def host_slot(url: str):
+    """
+    Waits for the turn of a request to the URL under the limits of its host.
+
+    :raises UpstreamOverloaded: if the request is shed
+    """
+    host = urlsplit(url).netloc
+    limits = _host_limits.get(host)
+    if limits is None:
+        yield
+        return
+    limiter = _limiters.get(host)
+    if limiter is None:
+        limiter = _limiters[host] = HostLimiter(host, limits)
+    async with limiter.slot():
+        yield
+
+
+def _collect_limits() -> Iterable:
+    for host, limits in _host_limits.items():
+        for limit, value in asdict(limits).items():
+            yield {"host": host, "limit": limit}, value
+
+
+REGISTRY.collected(
+    "freebooksapi_upstream_limits", "Configured limits of every limited host.", _collect_limits
+)
+
+
+async def get(
+    url,
+    jar=None,
+    proxy_list=None,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+    conditional: bool = False,
+):
+    """
+    :param conditional: revalidate the page retrieved last time with this
+    flag, raising :class:`NotModified` rather than returning it unchanged
+    """
+    headers = conditional_headers(url) if conditional else {}
+    if jar is not None or proxy_list:
+        # cookie jars and proxy chains are bound to a session so these
+        # requests can't go through the shared pool
         async with aiohttp.ClientSession(
             headers=HEAD,
             cookie_jar=jar,
             timeout=TIMEOUT,
             connector=ChainProxyConnector.from_urls(proxy_list) if proxy_list else None,
+            trace_configs=[trace_config()],
         ) as sess:
             logger.info("GET %s" % url)
-            async with sess.get(url) as resp:
-                return await resp.text()
-    except asyncio.exceptions.CancelledError:
-        raise LoopError("Asyncio loop had been closed before request could finish.")
+            async with host_slot(url):
+                with track_request(url) as outcome, span("ahttp.get", url=url):
+                    async with sess.get(
+                        url, headers=headers, **timeout_kwargs(timeout)
+                    ) as resp:
+                        return await _read(url, resp, outcome, conditional)
+
+    logger.info("GET %s" % url)
+    async with host_slot(url):
+        with track_request(url) as outcome, span("ahttp.get", url=url):
+            async with get_session().get(
+                url, headers=headers, **timeout_kwargs(timeout)
+            ) as resp:
+                return await _read(url, resp, outcome, conditional)
+
+
+async def get_page(
+    url,
+    proxy_list=[],
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+    conditional: bool = False,
+):
+    """
+    Retrieves the raw page content, parsing is left to `parsing.run_parser`
+    so that it happens off the event loop.
+
+    :raises NotModified: if `conditional` and the page is unchanged
+    """
+    with span("ahttp.get_page", url=url):
+        return await get(
+            url, proxy_list=proxy_list, timeout=timeout, conditional=conditional
+        )
+
+
+async def iter_page(
+    url, chunk_size=CHUNK_SIZE, timeout: Optional[aiohttp.ClientTimeout] = None
+) -> AsyncIterator[str]:
+    """
+    Retrieves the page content in decoded chunks as they arrive. Closing the
+    iterator early stops reading the response.
+    """
+    logger.info("GET %s (streamed)" % url)
+    # recorded once done rather than as the current span, the generator may
+    # be closed from another context than the one it started in
+    trace = current_trace()
+    start = trace.now() if trace is not None else 0
+    async with host_slot(url):
+        with track_request(url) as outcome:
+            try:
+                async with get_session().get(url, **timeout_kwargs(timeout)) as resp:
+                    outcome["status"] = str(resp.status)
+                    check_status(url, resp)
+                    decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")(
+                        errors="replace"
+                    )
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        outcome["bytes"] += len(chunk)
+                        yield decoder.decode(chunk)
+                    yield decoder.decode(b"", final=True)
+            finally:
+                if trace is not None:
+                    record_span(
+                        "ahttp.iter_page", start, trace.now(), url=url, bytes=outcome["bytes"]
+                    )
+
+
+class Hedger:
+    """
+    Sends a duplicate of a request, usually to another alias, when the first
+    hasn't answered within the given percentile of recent latencies and takes
+    whichever answers first, cancelling the other.
+
+    Hedges are limited to `budget` extra requests per request so that a slow
+    library isn't flooded with duplicates.
+
+    :param percentile: percentile of recent latencies to wait before hedging
+    :param budget: maximum ratio of hedged requests to requests
+    :param initial_delay: seconds to wait until enough latencies are recorded
+    :param min_delay: lower bound of the delay in seconds
+    :param window: number of recent latencies the percentile is taken over
+    :param min_samples: latencies needed before the percentile is used
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        budget: float = 0.1,
+        *,
+        initial_delay: float = 2.0,
+        min_delay: float = 0.05,
+        window: int = 200,
+        min_samples: int = 20,
+    ) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies: deque = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+
+    def delay(self) -> float:
+        if len(self.latencies) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(self.percentile / 100 * len(ordered)))
+        return max(self.min_delay, ordered[index])
+
+    def within_budget(self) -> bool:
+        return self.hedged < self.budget * self.requests
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable[T]],
+        backup: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> T:
+        """
+        Awaits `primary()`, hedging with `backup()` if it is slow. When both
+        are sent the first successful answer is returned, and the error of the
+        last one is raised if both fail.
+        """
+        self.requests += 1
+        start = monotonic()
+        first = asyncio.ensure_future(primary())
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.delay())
+            if not done and backup is not None:
+                if self.within_budget():
+                    self.hedged += 1
+                    pending.add(asyncio.ensure_future(backup()))
+                else:
+                    self.over_budget += 1
 
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    # retrieves every exception, also of tasks that lost
+                    error = task.exception() or error
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    if winners[0] is not first:
+                        self.hedge_wins += 1
+                    self.latencies.append(monotonic() - start)
+                    return winners[0].result()
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
 
-async def get_page(url, strain=None, proxy_list=[]):
-    con = await get(url, proxy_list=proxy_list)
-    with open("test.html", "w", encoding="utf-8") as f:
-        f.write(con)
-    return soup(con, features="lxml", parse_only=strain)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "over_budget": self.over_budget,
+            "budget": self.budget,
+            "delay_s": self.delay(),
+        }
@@ -0,0 +1,140 @@
+import asyncio
+from dataclasses import dataclass
+from logging import getLogger
+from time import monotonic
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+
+from .ahttp import get_session
+
+log = getLogger("aliases")
+
+
+@dataclass
+class AliasStats:
+    # exponentially weighted moving averages
+    latency: Optional[float] = None
+    error_rate: float = 0.0
+    consecutive_failures: int = 0
+    last_failure: float = 0.0
+
+
+class AliasPool:
+    """
+    Tracks the rolling latency and error rate of every alias (mirror host) of
+    a library and orders them so that requests go to the fastest healthy one
+    first.
+
+    An alias is unhealthy after `unhealthy_after` consecutive failures, it is
+    only tried as a last resort until it succeeds again or `cooldown` seconds
+    have passed since its last failure.
+    """
+
+    def __init__(
+        self,
+        bases: List[str],
+        *,
+        smoothing: float = 0.3,
+        unhealthy_after: int = 3,
+        cooldown: float = 60,
+    ) -> None:
+        self.bases: List[str] = []
+        for base in bases:
+            parts = urlsplit(base)
+            if parts.netloc and parts.netloc not in map(self.host, self.bases):
+                self.bases.append(f"{parts.scheme}://{parts.netloc}")
+        self.smoothing = smoothing
+        self.unhealthy_after = unhealthy_after
+        self.cooldown = cooldown
+        self.stats: Dict[str, AliasStats] = {base: AliasStats() for base in self.bases}
+
+    @staticmethod
+    def host(url: str) -> str:
+        return urlsplit(url).netloc
+
+    def owns(self, url: str) -> bool:
+        return self.host(url) in map(self.host, self.bases)
+
+    def rewrite(self, url: str, base: str) -> str:
+        """
+        Points the URL at another alias, keeping its path and query.
+        """
+        scheme, netloc = urlsplit(base)[:2]
+        return urlunsplit((scheme, netloc, *urlsplit(url)[2:]))
+
+    def is_healthy(self, base: str) -> bool:
+        stats = self.stats[base]
+        return (
+            stats.consecutive_failures < self.unhealthy_after
+            or monotonic() - stats.last_failure > self.cooldown
+        )
+
+    def score(self, base: str) -> float:
+        stats = self.stats[base]
+        if stats.latency is None:
+            # unmeasured aliases go after measured ones, in their listed order
+            return float("inf")
+        return stats.latency * (1 + 4 * stats.error_rate)
+
+    def candidates(self) -> List[str]:
+        """
+        Aliases in the order they should be tried.
+        """
+        return sorted(
+            self.bases, key=lambda base: (not self.is_healthy(base), self.score(base))
+        )
+
+    def record_success(self, base: str, latency: float):
+        stats = self.stats[base]
+        stats.latency = (
+            latency
+            if stats.latency is None
+            else stats.latency + self.smoothing * (latency - stats.latency)
+        )
+        stats.error_rate -= self.smoothing * stats.error_rate
+        stats.consecutive_failures = 0
+
+    def record_failure(self, base: str):
+        stats = self.stats[base]
+        stats.error_rate += self.smoothing * (1 - stats.error_rate)
+        stats.consecutive_failures += 1
+        stats.last_failure = monotonic()
+        if stats.consecutive_failures == self.unhealthy_after:
+            log.warning(f"Alias {base} is unhealthy.")
+
+    async def health_check(self, timeout: float = 10):
+        """
+        Requests the root page of every alias concurrently and records the
+        outcome, so that aliases are measured before requests depend on them.
+        """
+
+        async def check(base: str):
+            start = monotonic()
+            try:
+                async with get_session().get(
+                    f"{base}/", timeout=aiohttp.ClientTimeout(total=timeout)
+                ) as resp:
+                    await resp.read()
+                    healthy = resp.status < 500
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                healthy = False
+
+            if healthy:
+                self.record_success(base, monotonic() - start)
+            else:
+                self.record_failure(base)
+
+        await asyncio.gather(*(check(base) for base in self.bases))
+
+    def summary(self) -> List[Dict]:
+        return [
+            {
+                "alias": base,
+                "healthy": self.is_healthy(base),
+                "latency_ms": None if stats.latency is None else stats.latency * 1000,
+                "error_rate": stats.error_rate,
+            }
+            for base, stats in ((base, self.stats[base]) for base in self.candidates())
+        ]
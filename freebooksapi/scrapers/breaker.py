@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from logging import getLogger
+from time import monotonic
+from typing import Tuple, Type
+
+from .metrics import REGISTRY
+
+log = getLogger("breaker")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+# value of each state in the exported gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_REJECTED = REGISTRY.counter(
+    "freebooksapi_circuit_rejected_total",
+    "Requests failed fast because the circuit of their library was open.",
+    ("name",),
+)
+
+
+class CircuitOpen(Exception):
+    """The library is failing, requests to it are failed fast for now."""
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(
+            f"{name} is unavailable at this time, try again in {retry_after:.0f} seconds."
+        )
+
+
+class CircuitBreaker:
+    """
+    Fails requests to a library fast rather than waiting on it to time out
+    while it is down.
+
+    The circuit opens after `failure_threshold` consecutive failures, requests
+    then raise :class:`CircuitOpen` right away. Once `reset_timeout` seconds
+    have passed it half-opens and lets `half_open_probes` requests through at
+    a time, the first that succeeds closes it and one that fails opens it
+    again.
+
+    :param name: name of the library in errors and metrics
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        half_open_probes: int = 1,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self._state = CLOSED
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self.probes = 0
+        return self._state
+
+    def acquire(self):
+        """
+        :raises CircuitOpen: if the request mustn't be sent
+        """
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return
+        CIRCUIT_REJECTED.inc(name=self.name)
+        if state == OPEN:
+            retry_after = self.reset_timeout - (monotonic() - self.opened_at)
+        else:
+            # half-open with every probe taken, the probes decide whether it
+            # closes or stays open for another reset timeout
+            retry_after = self.reset_timeout
+        raise CircuitOpen(self.name, retry_after)
+
+    def record_success(self):
+        if self._state != CLOSED:
+            log.info(f"Circuit of {self.name} closed.")
+        self._state = CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == HALF_OPEN or (
+            self._state == CLOSED and self.failures >= self.failure_threshold
+        ):
+            log.warning(f"Circuit of {self.name} opened after {self.failures} failures.")
+            self._state = OPEN
+            self.opened_at = monotonic()
+            self.probes = 0
+
+    def release(self):
+        # a request ended without telling whether the library works
+        if self._state == HALF_OPEN and self.probes:
+            self.probes -= 1
+
+    @contextmanager
+    def guard(
+        self,
+        failures: Tuple[Type[BaseException], ...],
+        successes: Tuple[Type[BaseException], ...] = (),
+    ):
+        """
+        Lets the request within through if the circuit allows it and records
+        its outcome, only the given errors count as failures. Errors that
+        signal an answer (i.e. :class:`ahttp.NotModified`) count as successes.
+        """
+        self.acquire()
+        try:
+            yield
+        except failures:
+            self.record_failure()
+            raise
+        except successes:
+            self.record_success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        else:
+            self.record_success()
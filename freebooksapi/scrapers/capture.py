@@ -0,0 +1,156 @@
+import asyncio
+import gzip
+import hashlib
+import random
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .metrics import REGISTRY
+
+log = getLogger("capture")
+
+# kind of page each parse method handles, fixtures are grouped by it
+PARSER_KINDS = {
+    "parse_result": "search",
+    "parse_topics": "topics",
+    "parse_datadumps": "datadumps",
+    "parse_suburl": "suburl",
+}
+# captured pages are named with this prefix so that rotating never removes
+# pages put next to them by hand
+CAPTURE_PREFIX = "capture-"
+
+CAPTURES = REGISTRY.counter(
+    "freebooksapi_captures_total",
+    "Sampled upstream pages by whether they were written or dropped.",
+    ("result",),
+)
+
+_store: Optional["CaptureStore"] = None
+
+
+class CaptureStore:
+    """
+    Writes sampled raw upstream pages as gzipped fixtures laid out as
+    `<root>/<library>/<kind>/capture-<url hash>.html.gz`, the layout the
+    benchmarks read fixtures from. A page is keyed by its URL, capturing the
+    same URL again replaces it.
+
+    Pages are queued and written by a background task in the default
+    executor, pages sampled while the queue is full are dropped.
+
+    :param root: directory to write into
+    :param sample_rate: fraction of pages captured
+    :param max_pages: captured pages kept per library and kind, the oldest
+    are removed beyond it
+    :param max_queued: pages waiting to be written at most
+    :param libraries: library name of every agent class name, defaults to
+    the lowercased class name
+    """
+
+    def __init__(
+        self,
+        root: str,
+        *,
+        sample_rate: float = 0.05,
+        max_pages: int = 50,
+        max_queued: int = 100,
+        libraries: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.root = Path(root)
+        self.sample_rate = sample_rate
+        self.max_pages = max_pages
+        self.libraries = libraries or {}
+        self.max_queued = max_queued
+        # created on first use, within the running loop
+        self._queue: "Optional[asyncio.Queue[Tuple[str, str, str, str]]]" = None
+        self._writer: Optional[asyncio.Task] = None
+
+    def sampled(self) -> bool:
+        return random.random() < self.sample_rate
+
+    def capture(self, agent: Any, parser: str, url: str, content: str):
+        """
+        Queues the page for writing without waiting for it.
+        """
+        library = self.libraries.get(type(agent).__name__, type(agent).__name__.lower())
+        kind = PARSER_KINDS.get(parser, parser.replace("parse_", ""))
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queued)
+        try:
+            self._queue.put_nowait((library, kind, url, content))
+        except asyncio.QueueFull:
+            CAPTURES.inc(result="dropped")
+            return
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_queued())
+
+    async def close(self):
+        """
+        Writes the pages still queued and stops the writer.
+        """
+        if self._writer is not None and not self._writer.done():
+            await self._queue.join()  # type: ignore
+            self._writer.cancel()
+        self._writer = None
+
+    async def _write_queued(self):
+        loop = asyncio.get_running_loop()
+        assert self._queue is not None
+        while True:
+            page = await self._queue.get()
+            try:
+                await loop.run_in_executor(None, self._write, *page)
+                CAPTURES.inc(result="written")
+            except OSError:
+                CAPTURES.inc(result="dropped")
+                log.exception(f"Failed to capture {page[2]}.")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, library: str, kind: str, url: str, content: str):
+        directory = self.root / library / kind
+        directory.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha1(url.encode()).hexdigest()[:16]
+        path = directory / f"{CAPTURE_PREFIX}{name}.html.gz"
+        partial = path.with_suffix(".tmp")
+        partial.write_bytes(gzip.compress(content.encode("utf-8")))
+        partial.replace(path)
+        log.debug(f"Captured {url} as {path}.")
+
+        captured = sorted(
+            directory.glob(f"{CAPTURE_PREFIX}*.html.gz"),
+            key=lambda path: path.stat().st_mtime,
+        )
+        for old in captured[: max(0, len(captured) - self.max_pages)]:
+            old.unlink(missing_ok=True)
+
+
+def configure_capture(store: Optional[CaptureStore]):
+    """
+    Selects the store raw upstream pages are captured into, None stops
+    capturing.
+    """
+    global _store
+    _store = store
+
+
+def capturing() -> bool:
+    """
+    Whether a page fetched now should be captured, sampled.
+    """
+    return _store is not None and _store.sampled()
+
+
+def capture_page(agent: Any, parser: str, url: str, content: str):
+    """
+    Captures a page that `capturing` was sampled for.
+    """
+    if _store is not None:
+        _store.capture(agent, parser, url, content)
+
+
+async def close_capture():
+    if _store is not None:
+        await _store.close()
@@ -1,12 +1,20 @@
 import re
+from contextlib import nullcontext
 from logging import getLogger
+from time import perf_counter_ns
 from traceback import print_exception
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from urllib.parse import urlencode
 
-from .agent import Agent, SearchResult
+from lxml import etree
+
+from .agent import FAILOVER_ERRORS, Agent, SearchResult
+from .ahttp import iter_page
+from .capture import capture_page, capturing
 from .objects import Datadump, Publication, SearchUrlArgs
-from .utilities import get_href
+from .parsing import PARSE_SECONDS, incremental_lane, run_incremental
+from .tracing import span
+from .utilities import drop_lxml, get_href, get_href_lxml, get_text_lxml
 
 log = getLogger("libgen")
 
@@ -20,24 +28,115 @@ RE_SEARCH_INFO = re.compile(
 )
 RE_TOPIC_HREF = re.compile(r"topicid(\d*)")
 
+XP_TOPIC_LINKS = etree.XPath(
+    "(//div[@class='dropdown_5columns align_right'])[1]//a"
+)
+XP_TABLES = etree.XPath("//table")
+XP_ROWS = etree.XPath(".//tr")
+XP_CELLS = etree.XPath(".//td")
+XP_FONTS = etree.XPath(".//font")
+
+
+class ResultStream:
+    """
+    Incrementally parses a result page fed in chunks, rows of the result table
+    are extracted as soon as they are complete and discarded from the tree.
+
+    Rows are extracted with the lxml parser engine whichever engine the
+    agent uses, handing each row to BeautifulSoup made streaming a page
+    slower than parsing it whole.
+
+    A stream is always fed from the same thread, its `lane` (see
+    `parsing.incremental_lane`).
+    """
+
+    def __init__(self, agent: "GenLibRusEc") -> None:
+        self.agent = agent
+        self.lane = incremental_lane()
+        self.parser = etree.HTMLPullParser(events=("start", "end"), tag=("table", "tr"))
+        self.tables: List[Any] = []
+        self.rows_seen = 0
+        self.meta_text: Optional[str] = None
+        self.publications: List[Publication] = []
+
+    def feed(self, chunk: str):
+        self.parser.feed(chunk)
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                if elem.tag == "table":
+                    self.tables.append(elem)
+            elif elem.tag == "table":
+                if len(self.tables) > 1 and elem is self.tables[1]:
+                    td = next(elem.iter("td"), None)
+                    self.meta_text = "".join(td.itertext()) if td is not None else ""
+            elif len(self.tables) > 2 and self._table_of(elem) is self.tables[2]:
+                self.rows_seen += 1
+                # the first row is the table header
+                if self.rows_seen > 1:
+                    self._extract_row(elem)
+                self._discard(elem)
+
+    def close(self):
+        self.feed("")
+        self.parser.close()
+
+    def result(self) -> SearchResult:
+        total_files, show_range = self.agent._parse_search_info(
+            self.meta_text or "", len(self.publications)
+        )
+        return SearchResult(self.publications, total_files, show_range)
+
+    def _table_of(self, row):
+        parent = row.getparent()
+        while parent is not None and parent.tag != "table":
+            parent = parent.getparent()
+        return parent
+
+    def _extract_row(self, row):
+        try:
+            attrs = self.agent._extract_attributes_lxml(XP_CELLS(row))
+        except Exception as e:
+            print_exception(e.__class__, e, e.__traceback__)
+            return
+        self.publications.append(Publication(**attrs))
+
+    def _discard(self, row):
+        row.clear()
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+
 
 class GenLibRusEc(Agent):
+    page_sizes = (25, 50, 100)
+    sequential_ids = True
+
     def __init__(
         self,
         search_url="http://gen.lib.rus.ec/search.php",
         topics_url="http://gen.lib.rus.ec/",
         datadumps_url="https://libgen.is/dbdumps/",
+        streaming: bool = True,
+        engine: str = "soup",
     ) -> None:
+        """
+        :param streaming: parse search pages as they stream in and stop reading
+            once enough publications are found
+        :param engine: parser engine, see `parsing.PARSER_ENGINES`
+        """
         super().__init__(
-            search_url=search_url, topics_url=topics_url, datadumps_url=datadumps_url
+            search_url=search_url,
+            topics_url=topics_url,
+            datadumps_url=datadumps_url,
+            engine=engine,
         )
+        self.streaming = streaming
 
     def get_search_url(self, search_term: Optional[str], args: SearchUrlArgs) -> str:
         urlargs: Dict[str, Any] = {"page": args.page}
 
         if search_term:
             urlargs["req"] = search_term
-        if args.limit in (25, 50, 100):
+        if args.limit in self.page_sizes:
             urlargs["res"] = args.limit
         if args.topic_id:
             urlargs["req"] = f"topicid{args.topic_id}"
@@ -46,6 +145,95 @@ class GenLibRusEc(Agent):
 
         return f"{self.search_url}?{urlencode(urlargs)}"
 
+    async def fetch_result(self, page_url: str, urlargs: SearchUrlArgs) -> SearchResult:
+        if not self.streaming:
+            return await super().fetch_result(page_url, urlargs)
+
+        wanted = urlargs.wanted
+        return await self.with_failover(
+            page_url, lambda url, timeout: self._stream_result(url, wanted, timeout)
+        )
+
+    async def _stream_result(self, page_url: str, wanted: int, timeout) -> SearchResult:
+        stream = ResultStream(self)
+        chunks = iter_page(page_url, timeout=timeout)
+        # pages sampled for capturing are read to the end
+        captured: Optional[List[str]] = [] if capturing() else None
+        with span("agent.stream_result", url=page_url) as parsing:
+            parse_ns = 0
+            try:
+                async for chunk in chunks:
+                    if captured is not None:
+                        captured.append(chunk)
+                    start = perf_counter_ns()
+                    await run_incremental(stream.lane, stream.feed, chunk)
+                    parse_ns += perf_counter_ns() - start
+                    if len(stream.publications) >= wanted and captured is None:
+                        break
+                else:
+                    start = perf_counter_ns()
+                    await run_incremental(stream.lane, stream.close)
+                    parse_ns += perf_counter_ns() - start
+                    if captured is not None:
+                        capture_page(self, "parse_result", page_url, "".join(captured))
+            finally:
+                await chunks.aclose()
+                self._observe_parse(parse_ns)
+                if parsing is not None:
+                    # parsing is interleaved with the download
+                    parsing.attributes["parse_ms"] = parse_ns / 1e6
+        return stream.result()
+
+    def _observe_parse(self, parse_ns: int):
+        # a streamed page is parsed in steps, the time is that of all of them
+        # along with their wait for the lane, always with lxml
+        PARSE_SECONDS.observe(
+            parse_ns / 1e9,
+            agent=type(self).__name__,
+            parser="parse_result",
+            engine="lxml",
+        )
+
+    async def iter_search(
+        self, search_term: Optional[str], urlargs: SearchUrlArgs
+    ) -> AsyncIterator[Publication]:
+        if not self.streaming:
+            async for publication in super().iter_search(search_term, urlargs):
+                yield publication
+            return
+
+        if search_term and len(search_term) < 3:
+            raise ValueError("Your search term must be at least 3 characters long.")
+        # rows already sent can't be taken back, so rather than failing over
+        # midway the stream comes from the best alias
+        page_url = self.get_search_url(search_term, urlargs)
+        pool = self.get_alias_pool()
+        if pool.owns(page_url):
+            page_url = pool.rewrite(page_url, pool.candidates()[0])
+
+        stream = ResultStream(self)
+        chunks = iter_page(page_url)
+        sent = 0
+        parse_ns = 0
+        guard = self.breaker.guard(FAILOVER_ERRORS) if self.breaker else nullcontext()
+        with guard:
+            try:
+                async for chunk in chunks:
+                    start = perf_counter_ns()
+                    await run_incremental(stream.lane, stream.feed, chunk)
+                    parse_ns += perf_counter_ns() - start
+                    while sent < len(stream.publications):
+                        yield stream.publications[sent]
+                        sent += 1
+                start = perf_counter_ns()
+                await run_incremental(stream.lane, stream.close)
+                parse_ns += perf_counter_ns() - start
+                for publication in stream.publications[sent:]:
+                    yield publication
+            finally:
+                await chunks.aclose()
+                self._observe_parse(parse_ns)
+
     def parse_topics(self, page):
         column = page.find("div", {"class": "dropdown_5columns align_right"})
         hrefs = column.find_all("a")
@@ -53,6 +241,12 @@ class GenLibRusEc(Agent):
             a.text: int(RE_TOPIC_HREF.search(a.get("href")).groups()[0]) for a in hrefs
         }
 
+    def parse_topics_lxml(self, page):
+        return {
+            get_text_lxml(a): int(RE_TOPIC_HREF.search(a.get("href")).groups()[0])
+            for a in XP_TOPIC_LINKS(page)
+        }
+
     def parse_result(self, page):
         tables = page.find_all("table")
 
@@ -68,8 +262,30 @@ class GenLibRusEc(Agent):
             results.append(Publication(**attrs))
 
         meta_tags = tables[1].find_all("td")
+        total_files, show_range = self._parse_search_info(meta_tags[0].text, len(results))
+        return SearchResult(results, total_files, show_range)
 
-        meta_inf = RE_SEARCH_INFO.search(meta_tags[0].text)
+    def parse_result_lxml(self, page):
+        tables = XP_TABLES(page)
+
+        rows = XP_ROWS(tables[2])
+        results = []
+        for row in rows[1:]:
+            try:
+                attrs = self._extract_attributes_lxml(XP_CELLS(row))
+            except Exception as e:
+                print_exception(e.__class__, e, e.__traceback__)
+                continue
+            results.append(Publication(**attrs))
+
+        meta_tags = XP_CELLS(tables[1])
+        total_files, show_range = self._parse_search_info(
+            get_text_lxml(meta_tags[0]), len(results)
+        )
+        return SearchResult(results, total_files, show_range)
+
+    def _parse_search_info(self, text: str, found: int) -> Tuple[int, Tuple[int, int]]:
+        meta_inf = RE_SEARCH_INFO.search(text)
 
         if not meta_inf:
             # lack of metadata means no results were found
@@ -83,10 +299,10 @@ class GenLibRusEc(Agent):
                     int(meta_inf.groups()[2]),
                 )
                 if meta_inf.groups()[1] is not None
-                else (1, len(results))
+                else (1, found)
             )
 
-        return SearchResult(results, total_files, show_range)
+        return total_files, show_range
 
     def _extract_attributes(self, cells) -> Dict[str, Any]:
         attrs: Dict[str, Any] = {"edition": None, "series": None, "isbn": None}
@@ -133,6 +349,42 @@ class GenLibRusEc(Agent):
         attrs["mirrors"] = [library_lol, libgen_lc, library_bz]
         return attrs
 
+    def _extract_attributes_lxml(self, cells) -> Dict[str, Any]:
+        # mirrors `_extract_attributes` on lxml elements
+        attrs: Dict[str, Any] = {"edition": None, "series": None, "isbn": None}
+        text = [get_text_lxml(cell) for cell in cells[:9]]
+        attrs["id"] = int(text[0])
+        attrs["authors"] = text[1].strip() or None
+
+        for el in XP_FONTS(cells[2]):
+            et = get_text_lxml(el)
+            if RE_ISBN.search(et) is not None:
+                attrs["isbn"] = [
+                    RE_ISBN.search(N).group(0)  # type: ignore
+                    for N in et.split(",")
+                    if RE_ISBN.search(N) is not None
+                ]
+            elif RE_EDITION.search(et) is not None:
+                attrs["edition"] = et
+            else:
+                attrs["series"] = et
+            drop_lxml(el)
+
+        attrs["title"] = get_text_lxml(cells[2]).strip()
+
+        attrs["publisher"] = text[3] or None
+        attrs["year"] = int(text[4]) if text[4].isnumeric() else None
+        attrs["pages"] = text[5]
+        attrs["lang"] = text[6]
+        attrs["size"] = text[7]
+        attrs["extension"] = text[8]
+        attrs["mirrors"] = [
+            get_href_lxml(cells[9]),
+            get_href_lxml(cells[10]),
+            get_href_lxml(cells[11]),
+        ]
+        return attrs
+
     def _extract_dbdumps_attrs(self, cell):
         columns = cell.find_all("td")
         if not columns:
@@ -155,5 +407,26 @@ class GenLibRusEc(Agent):
                     dumps.append(Datadump(**attrs))
         return dumps
 
+    def _extract_dbdumps_attrs_lxml(self, row):
+        columns = XP_CELLS(row)
+        if not columns:
+            return {}
+        return {
+            "name": get_text_lxml(columns[0]),
+            "url": get_href_lxml(columns[0]),
+            "last_modified": get_text_lxml(columns[1]),
+            "size": get_text_lxml(columns[2]),
+            "description": get_text_lxml(columns[3]),
+        }
+
+    def parse_datadumps_lxml(self, page):
+        # the first three rows are table header and directory buttons
+        dumps = []
+        for row in XP_ROWS(page)[3:]:
+            attrs = self._extract_dbdumps_attrs_lxml(row)
+            if attrs:
+                dumps.append(Datadump(**attrs))
+        return dumps
+
     def get_aliases(self):
         return ["http://libgen.rs/", "http://libgen.is/", "http://libgen.st/"]
@@ -2,24 +2,36 @@ from urllib.parse import urlencode
 from traceback import print_exception
 from typing import Any, Dict
 
-from .genlibrusec import GenLibRusEc
+from lxml import etree
+
+from .genlibrusec import XP_CELLS, XP_ROWS, XP_TABLES, GenLibRusEc
 from .agent import SearchResult
 from .objects import Publication, SearchUrlArgs, Datadump
-from .utilities import get_href
+from .utilities import get_href, get_href_lxml, get_text_lxml
+
+XP_FILES_COUNT = etree.XPath("((//ul)[2]//span)[1]")
+XP_LINKS = etree.XPath(".//a")
+XP_GREEN_FONTS = etree.XPath(".//font[@color='green']")
 
 
 class LibGenLc(GenLibRusEc):
-    def __init__(self) -> None:
+    # publications are listed by their edition IDs, some without any
+    sequential_ids = False
+
+    def __init__(self, engine: str = "soup") -> None:
         super().__init__(
             search_url="https://libgen.lc/index.php",
             datadumps_url="https://libgen.lc/dirlist.php?dir=dbdumps",
+            # the result page layout differs from the parent library
+            streaming=False,
+            engine=engine,
         )
 
     # The topics and topic ids of the parent library and this library is the same so do not change the topics_url
     def get_search_url(self, search_term: str, args: SearchUrlArgs) -> str:
         # Gmode is needed to get the acutal table inside the html instead of a dummy html
         urlargs = {"req": search_term, "page": args.page, "gmode": "on"}
-        if args.limit in (25, 50, 100):
+        if args.limit in self.page_sizes:
             urlargs["res"] = args.limit
         if args.topic_id:
             # Booktopicid can be combined with the name to be more specific
@@ -54,6 +66,22 @@ class LibGenLc(GenLibRusEc):
                 results.append(Publication(**attrs))
         return SearchResult(results, int(total_files), (0, 0))
 
+    def parse_result_lxml(self, page):
+        tables = XP_TABLES(page)
+        files_count = XP_FILES_COUNT(page)
+        total_files = get_text_lxml(files_count[0]) if files_count else "??"
+        results = []
+        if int(total_files) > 0:
+            rows = XP_ROWS(tables[1])
+            for row in rows[1:]:
+                try:
+                    attrs = self._extract_attributes_lxml(XP_CELLS(row))
+                except Exception as e:
+                    print_exception(e.__class__, e, e.__traceback__)
+                    continue
+                results.append(Publication(**attrs))
+        return SearchResult(results, int(total_files), (0, 0))
+
     def _extract_attributes(self, cells) -> Dict[str, Any]:
         attrs: Dict[str, Any] = {
             "edition": None,
@@ -111,6 +139,57 @@ class LibGenLc(GenLibRusEc):
         ]
         return attrs
 
+    def _extract_attributes_lxml(self, cells) -> Dict[str, Any]:
+        # mirrors `_extract_attributes` on lxml elements
+        attrs: Dict[str, Any] = {
+            "edition": None,
+            "series": None,
+            "isbn": None,
+            "lang": "N/A",
+        }
+        offset = 0
+        if len(cells) == 9:
+            offset = 4
+            edition_and_series_container = cells[0].find(".//b")
+            if edition_and_series_container is not None:
+                edition_and_series_container = XP_LINKS(edition_and_series_container)
+                if len(edition_and_series_container) > 0:
+                    attrs["series"] = get_text_lxml(
+                        edition_and_series_container[0]
+                    ).strip()
+                if len(edition_and_series_container) > 1:
+                    attrs["edition"] = get_text_lxml(
+                        edition_and_series_container[1]
+                    ).strip()
+            t = cells[0].find("a")
+            if t is not None:
+                attrs["title"] = get_text_lxml(t)
+                attrs["id"] = t.get("href").split("id=")[-1]
+            else:
+                attrs["title"] = ""
+                attrs["id"] = (
+                    edition_and_series_container[0].get("href").split("id=")[-1]
+                )
+            isbn = []
+            for el in XP_GREEN_FONTS(cells[0]):
+                isbn += [i.strip() for i in get_text_lxml(el).split(";")]
+            attrs["isbn"] = isbn
+            attrs["authors"] = get_text_lxml(cells[1]).strip() or "N/A"
+            attrs["publisher"] = get_text_lxml(cells[2]) or "N/A"
+            year = get_text_lxml(cells[3])
+            attrs["year"] = int(year[:4]) if year else -1
+            attrs["lang"] = get_text_lxml(cells[4]) or "N/A"
+        else:
+            attrs["id"] = -1
+            attrs["title"] = get_text_lxml(cells[0].find(".//a"))
+            if attrs["title"] == "":
+                attrs["title"] = get_text_lxml(cells[0].find(".//span"))
+        attrs["pages"] = get_text_lxml(cells[1 + offset]).split("/")[-1].strip()
+        attrs["size"] = get_text_lxml(cells[2 + offset])
+        attrs["extension"] = get_text_lxml(cells[3 + offset])
+        attrs["mirrors"] = [link.get("href") for link in XP_LINKS(cells[4 + offset])]
+        return attrs
+
     def _extract_dbdumps_attrs(self, cell):
         columns = cell.find_all("td")
         if not columns:
@@ -132,5 +211,25 @@ class LibGenLc(GenLibRusEc):
                     dumps.append(Datadump(**attrs))
         return dumps
 
+    def _extract_dbdumps_attrs_lxml(self, row):
+        columns = XP_CELLS(row)
+        if not columns:
+            return {}
+        return {
+            "name": get_text_lxml(columns[0]),
+            "url": "https://libgen.lc/" + get_href_lxml(columns[0]),
+            "last_modified": get_text_lxml(columns[2]),
+            "size": f"{round(int(get_text_lxml(columns[1]))/(1024*1024),2)}Mb",
+            "description": "",
+        }
+
+    def parse_datadumps_lxml(self, page):
+        dumps = []
+        for row in XP_ROWS(page)[1:]:
+            attrs = self._extract_dbdumps_attrs_lxml(row)
+            if attrs:
+                dumps.append(Datadump(**attrs))
+        return dumps
+
     def get_aliases(self):
         return ["http://libgen.lc/", "http://libgen.gs/", "http://libgen.li/"]
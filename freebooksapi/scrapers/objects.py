@@ -40,6 +40,18 @@ class SearchUrlArgs:
     offset: int
     topic_id: Optional[int]
     search_mode: Optional[SearchMode]
+    # publications needed from the start of the page when fewer than offset +
+    # limit, i.e. on the last page of a window, the rest may be left unread
+    needed: Optional[int] = None
+
+    @property
+    def wanted(self) -> int:
+        """
+        Publications from the start of the page the search has to read.
+        """
+        if self.needed is None:
+            return self.offset + self.limit
+        return min(self.needed, self.offset + self.limit)
 
 
 @dataclass(frozen=True)
@@ -0,0 +1,169 @@
+import asyncio
+import functools
+import itertools
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from logging import getLogger
+from time import perf_counter_ns
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from bs4 import BeautifulSoup as soup
+from bs4 import SoupStrainer
+from lxml import html
+
+from .metrics import REGISTRY
+from .tracing import current_trace, record_span, span
+
+log = getLogger("parsing")
+
+PARSE_SECONDS = REGISTRY.histogram(
+    "freebooksapi_parse_seconds",
+    "Time to parse a page, including the wait for the parse pool, by agent, "
+    "parse method and engine.",
+    ("agent", "parser", "engine"),
+)
+
+EXECUTOR_KINDS = ("thread", "process")
+# "soup" parses with BeautifulSoup (on top of lxml), "lxml" hands the raw lxml
+# tree to the agent's `<parser>_lxml` counterpart
+PARSER_ENGINES = ("soup", "lxml")
+
+_executor: Optional[Executor] = None
+# single threaded executors that incremental parsers are pinned to, see
+# `incremental_lane`
+_lanes: List[ThreadPoolExecutor] = []
+_next_lane: Optional[Iterator[ThreadPoolExecutor]] = None
+_lane_count: Optional[int] = None
+
+
+def configure_parse_executor(
+    kind: str = "thread", max_workers: Optional[int] = None
+) -> Executor:
+    """
+    Selects the pool that pages are parsed in.
+
+    A thread pool keeps parsing off the event loop, a process pool additionally
+    spreads it across cores at the cost of pickling the agent, the page content
+    and the parsed objects between processes.
+
+    :param kind: either "thread" or "process"
+    :param max_workers: pool size, defaults to the executor's own default
+    """
+    global _executor, _lane_count
+    if kind not in EXECUTOR_KINDS:
+        raise ValueError(f"Parse executor must be one of {EXECUTOR_KINDS}, not '{kind}'.")
+
+    shutdown_parse_executor(wait=False)
+    _lane_count = max_workers
+    if kind == "process":
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        _executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="parse"
+        )
+    log.info(f"Parsing pages in a {kind} pool.")
+    return _executor
+
+
+def shutdown_parse_executor(wait: bool = True):
+    global _executor, _next_lane
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+    _executor = None
+    for lane in _lanes:
+        lane.shutdown(wait=wait)
+    _lanes.clear()
+    _next_lane = None
+
+
+def parse_page(
+    agent: Any, parser: str, content: str, strain: Optional[SoupStrainer] = None
+) -> Any:
+    """
+    Builds the tree for the page content with the agent's parser engine and
+    hands it to the named parse method. This is what runs inside the parse pool.
+    """
+    if agent.engine == "lxml":
+        # strainers are a BeautifulSoup concept, lxml parsers select themselves
+        return getattr(agent, f"{parser}_lxml")(html.document_fromstring(content))
+    return getattr(agent, parser)(soup(content, features="lxml", parse_only=strain))
+
+
+def profile_parse_page(
+    agent: Any, parser: str, content: str, strain: Optional[SoupStrainer] = None
+) -> Tuple[Any, int, int]:
+    """
+    `parse_page` that also measures the time spent building the tree and in
+    the parse method.
+
+    :returns: (parsed, tree building nanoseconds, parse method nanoseconds)
+    """
+    start = perf_counter_ns()
+    if agent.engine == "lxml":
+        tree = html.document_fromstring(content)
+        method = getattr(agent, f"{parser}_lxml")
+    else:
+        tree = soup(content, features="lxml", parse_only=strain)
+        method = getattr(agent, parser)
+    built = perf_counter_ns()
+    parsed = method(tree)
+    return parsed, built - start, perf_counter_ns() - built
+
+
+async def run_parser(
+    agent: Any, parser: str, content: str, strain: Optional[SoupStrainer] = None
+) -> Any:
+    """
+    Runs `parse_page` in the configured parse pool (or the loop's default
+    executor when none is configured) without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    trace = current_trace()
+    with PARSE_SECONDS.time(
+        agent=type(agent).__name__, parser=parser, engine=agent.engine
+    ):
+        if trace is None:
+            return await loop.run_in_executor(
+                _executor, functools.partial(parse_page, agent, parser, content, strain)
+            )
+
+        with span("parse", parser=parser, engine=agent.engine, chars=len(content)):
+            parsed, tree_ns, method_ns = await loop.run_in_executor(
+                _executor,
+                functools.partial(profile_parse_page, agent, parser, content, strain),
+            )
+            # the rest of the parse span is the wait for the pool
+            end = trace.now()
+            record_span("parse.tree", end - method_ns - tree_ns, end - method_ns)
+            record_span(f"parse.{parser}", end - method_ns, end)
+            return parsed
+
+
+def incremental_lane() -> Executor:
+    """
+    The executor an incremental parser (i.e. `ResultStream`) runs its steps
+    in, for as long as it lives.
+
+    An lxml parser fed from several threads corrupts memory, so rather than
+    in the parse pool each incremental parser runs in one of a set of single
+    threaded lanes, taken in turn. They are as many as the parse pool's
+    workers, or the number of cores when that isn't set.
+    """
+    global _next_lane
+    if _next_lane is None:
+        _lanes.extend(
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="parse-lane")
+            for _ in range(_lane_count or os.cpu_count() or 1)
+        )
+        _next_lane = itertools.cycle(_lanes)
+    return next(_next_lane)
+
+
+async def run_incremental(lane: Executor, call: Callable[..., Any], *args) -> Any:
+    """
+    Runs a step of an incremental parser (i.e. feeding it the next chunk of a
+    page) in its lane without blocking the event loop.
+
+    :param lane: the parser's lane, see `incremental_lane`
+    """
+    return await asyncio.get_running_loop().run_in_executor(lane, call, *args)
@@ -1,10 +1,36 @@
-from typing import Optional
-from urllib.parse import urlencode, urlparse
+import asyncio
+from dataclasses import dataclass, replace
+from logging import getLogger
+from traceback import print_exception
+from typing import Optional, Tuple
+from urllib.parse import urlencode, urljoin, urlparse
 from bs4 import SoupStrainer
+from lxml import etree
 from .objects import Publication, SearchResult, SearchUrlArgs, Datadump
 from .agent import Agent
-from .ahttp import get_page
-from .utilities import get_href
+from .utilities import get_href, get_href_lxml, get_text_lxml
+
+log = getLogger("planetebooks")
+
+# strainers are handed the raw attributes while the page is parsed, so unlike
+# find_all they match the class attribute as a whole (class="buttonpe" but not
+# class="buttonpe pdf"), so do these
+XP_COVERS = etree.XPath("//h2[@class='fusion-post-title']")
+XP_YEAR = etree.XPath("(//h6)[1]")
+XP_BUTTONS = etree.XPath("//a[@class='buttonpe'][@href]")
+XP_DATADUMPS = etree.XPath("//p[@class='pelistlinks']")
+XP_LINK = etree.XPath("(.//a)[1]")
+
+
+@dataclass(frozen=True)
+class ListedResult(SearchResult):
+    """
+    A parsed search page, whose publications are completed from their detail
+    pages by `PlanetEBooks.complete_result`.
+    """
+
+    # the detail page of each publication, in order
+    detail_urls: Tuple[str, ...] = ()
 
 
 def suburl_soupstrainer(elem, attrs):
@@ -20,15 +46,21 @@ def suburl_soupstrainer(elem, attrs):
 class PlanetEBooks(Agent):
     suburl_soupstrain = SoupStrainer(suburl_soupstrainer)
 
-    def __init__(
-        self,
-    ) -> None:
+    def __init__(self, suburl_concurrency: int = 8, engine: str = "soup") -> None:
+        """
+        :param suburl_concurrency: maximum number of book detail pages fetched
+            at the same time while completing a search result
+        :param engine: parser engine, see `parsing.PARSER_ENGINES`
+        """
+        self.suburl_concurrency = suburl_concurrency
+        self._suburl_semaphore: Optional[asyncio.Semaphore] = None
         super().__init__(
             search_url="https://www.planetebook.com/",
             topics_url=None,
             datadumps_url="https://www.planetebook.com/ebooks/",
             search_strain=SoupStrainer("h2", {"class": "fusion-post-title"}),
             datadumps_strain=SoupStrainer("p", {"class": "pelistlinks"}),
+            engine=engine,
         )
 
     def get_search_url(self, search_term: Optional[str], urlargs: SearchUrlArgs) -> str:
@@ -39,50 +71,139 @@ class PlanetEBooks(Agent):
     def parse_topics(self, page):
         raise NotImplementedError
 
-    async def _follow_suburl(self, suburl: str, attrs: dict):
-        page = await get_page(suburl, self.suburl_soupstrain)
+    def _get_suburl_semaphore(self) -> asyncio.Semaphore:
+        # created lazily so that it binds to the running event loop
+        if self._suburl_semaphore is None:
+            self._suburl_semaphore = asyncio.Semaphore(self.suburl_concurrency)
+        return self._suburl_semaphore
+
+    async def _follow_suburl(
+        self, publication: Publication, detail_url: str
+    ) -> Publication:
+        async with self._get_suburl_semaphore():
+            details = await self.fetch_parsed(
+                detail_url, "parse_suburl", self.suburl_soupstrain
+            )
+        return replace(publication, **details)
+
+    def parse_suburl(self, page):
         year = page.find("h6").text.split(",").pop().strip()
-        attrs["year"] = int(year) if year.isnumeric() else year if year else None
-        attrs["mirrors"] = [
-            self._join_relative_url(url.get("href"))
-            for url in page.find_all("a", {"class": "buttonpe"}, href=True)
-        ]
+        return {
+            "year": int(year) if year.isnumeric() else year if year else None,
+            "mirrors": [
+                self._join_relative_url(url.get("href"))
+                for url in page.find_all("a", {"class": "buttonpe"}, href=True)
+            ],
+        }
+
+    def parse_suburl_lxml(self, page):
+        year = get_text_lxml(XP_YEAR(page)[0]).split(",").pop().strip()
+        return {
+            "year": int(year) if year.isnumeric() else year if year else None,
+            "mirrors": [
+                self._join_relative_url(url.get("href")) for url in XP_BUTTONS(page)
+            ],
+        }
 
     def _join_relative_url(self, relative_url):
         return f"{self.search_url[:-1]}{relative_url}"
 
-    async def parse_result(self, page):
+    def parse_result(self, page):
         covers = page.find_all(self.search_strain)
         found = len(covers)
 
-        results = []
-        for sample in covers:
-            attrs = {}
-            attrs["title"] = sample.text
-            sub_url = get_href(sample)
-            attrs["id"] = urlparse(sub_url).path.replace("/", "")
-            await self._follow_suburl(sub_url, attrs)
-            results.append(attrs)
+        # year and mirrors are only listed on the detail page of each book,
+        # these are filled in by `complete_result`
+        return ListedResult(
+            [
+                Publication(
+                    id=urlparse(get_href(sample)).path.replace("/", ""),
+                    title=sample.text,
+                    authors="",
+                    isbn=None,
+                    edition=None,
+                    series=None,
+                    publisher=None,
+                    year=None,
+                    pages="",
+                    lang="",
+                    size="",
+                    extension="",
+                    mirrors=[],
+                )
+                for sample in covers
+            ],
+            found,
+            (found, found),
+            tuple(urljoin(self.search_url, get_href(sample)) for sample in covers),
+        )
+
+    def parse_result_lxml(self, page):
+        covers = XP_COVERS(page)
+        found = len(covers)
 
-        return SearchResult(
+        return ListedResult(
             [
                 Publication(
+                    id=urlparse(get_href_lxml(sample)).path.replace("/", ""),
+                    title=get_text_lxml(sample),
                     authors="",
                     isbn=None,
                     edition=None,
                     series=None,
                     publisher=None,
+                    year=None,
                     pages="",
                     lang="",
                     size="",
                     extension="",
-                    **res,
+                    mirrors=[],
                 )
-                for res in results
+                for sample in covers
             ],
             found,
             (found, found),
+            tuple(urljoin(self.search_url, get_href_lxml(sample)) for sample in covers),
+        )
+
+    async def complete_result(self, result: ListedResult) -> SearchResult:
+        # detail pages are fetched concurrently
+        publications = await asyncio.gather(
+            *(
+                self._complete_publication(pub, url)
+                for pub, url in zip(result.publications, result.detail_urls)
+            )
         )
+        return SearchResult(list(publications), result.total_found, result.showing_range)
+
+    async def iter_search(self, search_term: Optional[str], urlargs: SearchUrlArgs):
+        # every detail page is requested right away, publications are yielded
+        # in order as soon as theirs is in
+        result = await self.fetch_parsed(
+            self.get_search_url(search_term, urlargs), "parse_result", self.search_strain
+        )
+        tasks = [
+            asyncio.ensure_future(self._complete_publication(pub, url))
+            for pub, url in zip(result.publications, result.detail_urls)
+        ]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _complete_publication(
+        self, publication: Publication, detail_url: str
+    ) -> Publication:
+        # a failing detail page only leaves its publication without a year
+        # and mirrors
+        try:
+            return await self._follow_suburl(publication, detail_url)
+        except Exception as e:
+            log.warning(f'Could not follow the detail page of "{publication.id}".')
+            print_exception(e.__class__, e, e.__traceback__)
+            return publication
 
     def parse_datadumps(self, page):
         items = page.find_all(self.datadumps_strain)
@@ -96,3 +217,15 @@ class PlanetEBooks(Agent):
             )
             for i in items
         ]
+
+    def parse_datadumps_lxml(self, page):
+        return [
+            Datadump(
+                name=get_text_lxml(XP_LINK(i)[0]),
+                url=self._join_relative_url(get_href_lxml(i)),
+                last_modified="N/A",
+                size="N/A",
+                description=get_text_lxml(i),
+            )
+            for i in XP_DATADUMPS(page)
+        ]
@@ -0,0 +1,253 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter_ns, time_ns
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional
+
+import aiohttp
+
+# a trace records at most this many spans, the rest are dropped
+MAX_SPANS = 1000
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    # nanoseconds since the start of the trace
+    start: int
+    end: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end is None else (self.end - self.start) / 1e6
+
+
+class Trace:
+    """
+    Timeline of the spans recorded while serving one request. Spans are
+    recorded by whatever runs in the context the trace was started in, tasks
+    included, until the trace is finished.
+    """
+
+    def __init__(self) -> None:
+        self.trace_id = os.urandom(16).hex()
+        self.started_at = time_ns()
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.finished = False
+        self._origin = perf_counter_ns()
+
+    def now(self) -> int:
+        return perf_counter_ns() - self._origin
+
+    def add(
+        self,
+        name: str,
+        start: int,
+        end: Optional[int] = None,
+        parent: Optional[Span] = None,
+        **attributes,
+    ) -> Optional[Span]:
+        if self.finished:
+            # i.e. background tasks that outlive the request
+            return None
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(
+            name,
+            os.urandom(8).hex(),
+            parent.span_id if parent is not None else None,
+            start,
+            end,
+            attributes,
+        )
+        self.spans.append(span)
+        return span
+
+    def finish(self):
+        self.finished = True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "dropped_spans": self.dropped,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "start_ms": span.start / 1e6,
+                    "duration_ms": span.duration_ms,
+                    "attributes": span.attributes,
+                }
+                for span in self.spans
+            ],
+        }
+
+    def server_timing(self) -> str:
+        """
+        The spans as a Server-Timing header, which browser devtools show
+        along with the request.
+        """
+        return ", ".join(
+            f"{span.name};dur={span.duration_ms:.2f}"
+            for span in self.spans
+            if span.end is not None
+        )
+
+    def to_otlp(self, service_name: str = "freebooksapi") -> Dict[str, Any]:
+        """
+        The trace in the OTLP/JSON encoding that OpenTelemetry collectors
+        accept on /v1/traces.
+        """
+
+        def attribute(key: str, value: Any) -> Dict[str, Any]:
+            if isinstance(value, bool):
+                encoded = {"boolValue": value}
+            elif isinstance(value, int):
+                encoded = {"intValue": str(value)}
+            elif isinstance(value, float):
+                encoded = {"doubleValue": value}
+            else:
+                encoded = {"stringValue": str(value)}
+            return {"key": key, "value": encoded}
+
+        origin = self.started_at
+        spans = [
+            {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                # SPAN_KIND_INTERNAL
+                "kind": 1,
+                "startTimeUnixNano": str(origin + span.start),
+                "endTimeUnixNano": str(origin + (span.end or span.start)),
+                "attributes": [attribute(k, v) for k, v in span.attributes.items()],
+            }
+            for span in self.spans
+        ]
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [attribute("service.name", service_name)]},
+                    "scopeSpans": [{"scope": {"name": "freebooksapi"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+@contextmanager
+def tracing() -> Iterator[Trace]:
+    """
+    Records the spans of everything run within, and in tasks started within,
+    into a new trace.
+    """
+    trace = Trace()
+    trace_token = _trace.set(trace)
+    span_token = _span.set(None)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Records the time spent within as a span of the current trace, nested
+    under the current span. Does nothing when no trace is being recorded.
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+
+    recorded = trace.add(name, trace.now(), parent=_span.get(), **attributes)
+    if recorded is None:
+        yield None
+        return
+
+    token = _span.set(recorded)
+    try:
+        yield recorded
+    except BaseException as exc:
+        recorded.attributes["error"] = type(exc).__name__
+        raise
+    finally:
+        recorded.end = trace.now()
+        _span.reset(token)
+
+
+def record_span(name: str, start: int, end: int, **attributes) -> Optional[Span]:
+    """
+    Records an already measured span under the current span, times being
+    those of `Trace.now`.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return None
+    return trace.add(name, start, end, parent=_span.get(), **attributes)
+
+
+def _elapsed_span(name: str):
+    # a trace config callback pair recording the time between them as a span
+    async def on_start(session, ctx: SimpleNamespace, params):
+        trace = _trace.get()
+        if trace is not None:
+            setattr(ctx, name, trace.now())
+
+    async def on_end(session, ctx: SimpleNamespace, params):
+        start = getattr(ctx, name, None)
+        trace = _trace.get()
+        if start is not None and trace is not None:
+            attributes = {}
+            if hasattr(params, "host"):
+                attributes["host"] = params.host
+            if hasattr(params, "response"):
+                attributes["status"] = params.response.status
+            record_span(name, start, trace.now(), **attributes)
+
+    return on_start, on_end
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    Connection level spans of the requests made while a trace is recorded:
+    DNS lookups, connecting (including the TLS handshake) and the time to the
+    response headers. Reading the body is recorded by `ahttp`.
+    """
+    config = aiohttp.TraceConfig()
+    dns_start, dns_end = _elapsed_span("http.dns")
+    config.on_dns_resolvehost_start.append(dns_start)
+    config.on_dns_resolvehost_end.append(dns_end)
+    connect_start, connect_end = _elapsed_span("http.connect")
+    config.on_connection_create_start.append(connect_start)
+    config.on_connection_create_end.append(connect_end)
+    ttfb_start, ttfb_end = _elapsed_span("http.ttfb")
+    config.on_request_start.append(ttfb_start)
+    config.on_request_end.append(ttfb_end)
+
+    async def on_reuse(session, ctx: SimpleNamespace, params):
+        current = _span.get()
+        if current is not None:
+            current.attributes["reused_connection"] = True
+
+    config.on_connection_reuseconn.append(on_reuse)
+    return config
@@ -1,6 +1,9 @@
 from typing import Any, Optional
 
 from bs4 import Tag
+from lxml import etree
+
+XP_HREF = etree.XPath("(.//a[@href])[1]/@href")
 
 
 def get_href(cell: Tag) -> Optional[str]:
@@ -9,6 +12,35 @@ def get_href(cell: Tag) -> Optional[str]:
     return None if first is None else first.get("href")
 
 
+def get_href_lxml(elem: etree._Element) -> Optional[str]:
+    hrefs = XP_HREF(elem)
+    return str(hrefs[0]) if hrefs else None
+
+
+def get_text_lxml(elem: etree._Element) -> str:
+    """
+    All the text within the element, equivalent to `Tag.text`.
+    """
+    return "".join(elem.itertext())
+
+
+def drop_lxml(elem: etree._Element):
+    """
+    Removes the element from its tree while keeping its tail text, equivalent
+    to `Tag.extract`.
+    """
+    parent = elem.getparent()
+    if parent is None:
+        return
+    if elem.tail:
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + elem.tail
+        else:
+            parent.text = (parent.text or "") + elem.tail
+    parent.remove(elem)
+
+
 def try_int(obj: Any):
     if str(obj).isnumeric():
         return int(str(obj))
@@ -0,0 +1,111 @@
+"""
+How requests fail over between the aliases of a library, against stand-in
+servers on localhost.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from scrapers import ahttp, aliases  # noqa: E402
+from scrapers.aliases import AliasPool  # noqa: E402
+from scrapers.genlibrusec import GenLibRusEc  # noqa: E402
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+async def working(request):
+    return web.Response(text="page", content_type="text/html")
+
+
+async def failing(request):
+    return web.Response(status=502)
+
+
+async def hanging(request):
+    await asyncio.sleep(60)
+    return web.Response(text="too late", content_type="text/html")
+
+
+async def search_through(handlers, attempt_timeout=20):
+    servers = [await serve(handler) for handler in handlers]
+    bases = [base for _, base in servers]
+    agent = GenLibRusEc(search_url=f"{bases[0]}/search.php")
+    agent.attempt_timeout = attempt_timeout
+    agent.get_aliases = lambda: bases[1:]
+    try:
+        page = await agent.with_failover(
+            f"{bases[0]}/search.php?req=python",
+            lambda url, timeout: ahttp.get(url, timeout=timeout),
+        )
+        return page, agent.get_alias_pool(), bases
+    finally:
+        await ahttp.close_session()
+        for runner, _ in servers:
+            await runner.cleanup()
+
+
+def test_a_failing_alias_is_retried_on_the_next():
+    page, pool, (failed, working_base) = asyncio.run(search_through([failing, working]))
+    assert page == "page"
+    assert pool.stats[failed].consecutive_failures == 1
+    assert pool.candidates() == [working_base, failed]
+
+
+def test_a_hanging_alias_is_retried_after_the_attempt_timeout():
+    page, pool, (_, working_base) = asyncio.run(
+        search_through([hanging, working], attempt_timeout=0.2)
+    )
+    assert page == "page"
+    assert pool.candidates()[0] == working_base
+
+
+def test_health_checks_order_the_aliases():
+    async def run():
+        servers = [await serve(handler) for handler in (failing, working)]
+        failed, working_base = [base for _, base in servers]
+        pool = AliasPool([failed, working_base], unhealthy_after=1)
+        try:
+            await pool.health_check(timeout=5)
+        finally:
+            await ahttp.close_session()
+            for runner, _ in servers:
+                await runner.cleanup()
+        assert pool.candidates() == [working_base, failed]
+        assert not pool.is_healthy(failed)
+
+    asyncio.run(run())
+
+
+def test_an_unhealthy_alias_is_tried_again_after_the_cooldown(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(aliases, "monotonic", lambda: now[0])
+    pool = AliasPool(
+        ["http://libgen.rs", "http://libgen.is"], unhealthy_after=2, cooldown=60
+    )
+    pool.record_success("http://libgen.rs", 0.1)
+    pool.record_success("http://libgen.is", 0.5)
+    assert pool.candidates() == ["http://libgen.rs", "http://libgen.is"]
+
+    pool.record_failure("http://libgen.rs")
+    pool.record_failure("http://libgen.rs")
+    assert pool.candidates() == ["http://libgen.is", "http://libgen.rs"]
+
+    now[0] += 61
+    assert pool.is_healthy("http://libgen.rs")
+    pool.record_success("http://libgen.rs", 0.1)
+    assert pool.candidates()[0] == "http://libgen.rs"
@@ -0,0 +1,104 @@
+"""
+How the circuit breaker of a library opens, half-opens and closes again.
+
+    python -m pytest tests
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from scrapers import breaker  # noqa: E402
+from scrapers.breaker import (  # noqa: E402
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpen,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(breaker, "monotonic", clock)
+    return clock
+
+
+def test_opens_after_consecutive_failures(clock):
+    circuit = CircuitBreaker("libgen", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        circuit.acquire()
+        circuit.record_failure()
+    circuit.acquire()
+    circuit.record_success()
+    assert circuit.state == CLOSED
+
+    for _ in range(3):
+        circuit.acquire()
+        circuit.record_failure()
+    assert circuit.state == OPEN
+
+    clock.now += 10
+    with pytest.raises(CircuitOpen) as rejected:
+        circuit.acquire()
+    assert rejected.value.retry_after == 20
+
+
+def test_half_opens_for_one_probe_at_a_time(clock):
+    circuit = CircuitBreaker("libgen", failure_threshold=1, reset_timeout=30)
+    circuit.acquire()
+    circuit.record_failure()
+    clock.now += 30
+    assert circuit.state == HALF_OPEN
+
+    circuit.acquire()
+    with pytest.raises(CircuitOpen) as rejected:
+        circuit.acquire()
+    assert rejected.value.retry_after > 0
+
+    # a probe ending without an answer lets the next one through
+    circuit.release()
+    circuit.acquire()
+    circuit.record_success()
+    assert circuit.state == CLOSED
+    circuit.acquire()
+
+
+def test_a_failed_probe_opens_it_again(clock):
+    circuit = CircuitBreaker("libgen", failure_threshold=1, reset_timeout=30)
+    circuit.acquire()
+    circuit.record_failure()
+    clock.now += 30
+    circuit.acquire()
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpen) as rejected:
+        circuit.acquire()
+    assert rejected.value.retry_after == 30
+
+
+def test_guard_counts_only_the_given_errors(clock):
+    circuit = CircuitBreaker("libgen", failure_threshold=1, reset_timeout=30)
+    with pytest.raises(KeyError):
+        with circuit.guard((ConnectionError,)):
+            raise KeyError("not the library's fault")
+    assert circuit.state == CLOSED
+
+    with pytest.raises(ConnectionError):
+        with circuit.guard((ConnectionError,)):
+            raise ConnectionError()
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpen):
+        with circuit.guard((ConnectionError,)):
+            pass
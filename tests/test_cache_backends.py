@@ -0,0 +1,83 @@
+"""
+Runs the cache backends behind `misc.set_cache`/`misc.get_cache` through the
+same checks, the Redis one against fakeredis standing in for a server.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+import misc  # noqa: E402
+from misc import (  # noqa: E402
+    MemoryCacheBackend,
+    RedisCacheBackend,
+    SqliteCacheBackend,
+    cache_backend_from_url,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryCacheBackend()
+    elif request.param == "sqlite":
+        backend = SqliteCacheBackend(str(tmp_path / "cache.db"))
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        backend = RedisCacheBackend("redis://localhost", client=fakeredis.FakeRedis())
+    previous = misc.CACHE_BACKEND
+    misc.set_cache_backend(backend)
+    yield backend
+    misc.set_cache_backend(previous)
+    backend.close()
+
+
+def test_backend_round_trip(backend):
+    with pytest.raises(KeyError):
+        backend.get("libgen/topics")
+    backend.set("libgen/topics", {"Technology": 210})
+    assert backend.get("libgen/topics") == {"Technology": 210}
+    backend.delete("libgen/topics")
+    with pytest.raises(KeyError):
+        backend.get("libgen/topics")
+
+
+def test_cache_functions(backend):
+    async def run():
+        assert not await misc.is_cached("libgen/datadumps")
+        with pytest.raises(KeyError):
+            await misc.touch_cache("libgen/datadumps")
+
+        await misc.set_cache("libgen/datadumps", ["dump"])
+        value, cached_at = await misc.get_cache_entry("libgen/datadumps")
+        assert await misc.is_cached("libgen/datadumps")
+        assert value == await misc.get_cache("libgen/datadumps") == ["dump"]
+
+        await asyncio.sleep(0.01)
+        await misc.touch_cache("libgen/datadumps")
+        assert (await misc.get_cache_entry("libgen/datadumps"))[1] > cached_at
+
+    asyncio.run(run())
+
+
+def test_redis_keys_are_prefixed():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    RedisCacheBackend("redis://localhost", prefix="test:", client=client).set("a", 1)
+    assert client.get("test:a") == b"1"
+
+
+def test_sqlite_urls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    relative = cache_backend_from_url("sqlite:///cache.db")
+    absolute = cache_backend_from_url(f"sqlite:///{tmp_path / 'other.db'}")
+    assert (relative.path, absolute.path) == ("cache.db", str(tmp_path / "other.db"))
+    relative.close()
+    absolute.close()
+    with pytest.raises(ValueError):
+        cache_backend_from_url("sqlite://cache.db")
@@ -0,0 +1,109 @@
+"""
+When the cached topics and datadumps endpoints wait for a refresh and when
+they serve what is cached.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+from time import monotonic, time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+import misc  # noqa: E402
+from misc import MemoryCacheBackend, cache_cascade  # noqa: E402
+from models import LibraryAll  # noqa: E402
+
+HOUR = 60 * 60
+
+
+class CountingBackend(MemoryCacheBackend):
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    def get(self, cache_id):
+        self.gets += 1
+        return super().get(cache_id)
+
+
+def serve(refresh, entry_age=None, **options):
+    """
+    Requests an endpoint cached for 1 hour, and up to 2 before waiting on a
+    refresh, whose entry is `entry_age` seconds old (None for no entry).
+
+    :returns: (response, seconds it took, backend reads it made)
+    """
+
+    async def run():
+        backend = CountingBackend()
+        misc.set_cache_backend(backend)
+        if entry_age is not None:
+            backend.set("libgen/topics", {"value": "old", "cached_at": time() - entry_age})
+
+        async def caching_task(cache_id):
+            # the precaching refresh is left out
+            if started:
+                await refresh(cache_id)
+
+        started = False
+        endpoint = cache_cascade("{library}/topics", 1, 2, caching_task, **options)(
+            lambda library: None
+        )
+        await asyncio.sleep(0.01)
+        started = True
+        backend.gets = 0
+
+        start = monotonic()
+        response = await endpoint(LibraryAll.libgen)
+        return response, monotonic() - start, backend.gets
+
+    try:
+        return asyncio.run(run())
+    finally:
+        misc.set_cache_backend(MemoryCacheBackend())
+
+
+async def refreshed(cache_id):
+    # refreshes are handed the cache ID of every library
+    await misc.set_cache(cache_id.format(library="libgen"), "new")
+
+
+async def failing(cache_id):
+    raise ConnectionError("upstream is down")
+
+
+async def hanging(cache_id):
+    await asyncio.sleep(60)
+
+
+def test_a_fresh_entry_is_read_once():
+    response, _, gets = serve(failing, entry_age=10)
+    assert (response, gets) == ("old", 1)
+
+
+def test_a_stale_entry_is_served_while_refreshing():
+    response, _, gets = serve(refreshed, entry_age=1.5 * HOUR)
+    assert (response, gets) == ("old", 1)
+
+
+def test_a_missing_entry_waits_for_the_refresh():
+    response, _, gets = serve(refreshed)
+    assert (response, gets) == ("new", 2)
+
+
+def test_an_expired_entry_waits_for_the_refresh():
+    response, _, _ = serve(refreshed, entry_age=3 * HOUR)
+    assert response == "new"
+
+
+def test_an_expired_entry_is_served_when_the_refresh_fails():
+    response, _, _ = serve(failing, entry_age=3 * HOUR)
+    assert response == "old"
+
+
+def test_an_expired_entry_waits_for_a_slow_refresh_only_so_long():
+    response, took, _ = serve(hanging, entry_age=3 * HOUR, max_stale_wait_s=0.05)
+    assert response == "old"
+    assert took < 1
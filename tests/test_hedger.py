@@ -0,0 +1,89 @@
+"""
+When a slow request is hedged with a duplicate and which answer is taken.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from scrapers.ahttp import Hedger  # noqa: E402
+
+
+def answer(value, after=0.0, cancelled=None):
+    async def request():
+        try:
+            await asyncio.sleep(after)
+        except asyncio.CancelledError:
+            if cancelled is not None:
+                cancelled.append(value)
+            raise
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    return request
+
+
+def test_a_fast_request_is_not_hedged():
+    async def run():
+        hedger = Hedger(budget=1, initial_delay=0.1)
+        assert await hedger.run(answer("primary"), answer("backup")) == "primary"
+        assert (hedger.requests, hedger.hedged) == (1, 0)
+
+    asyncio.run(run())
+
+
+def test_a_slow_request_loses_to_its_hedge():
+    async def run():
+        hedger = Hedger(budget=1, initial_delay=0.02)
+        cancelled = []
+        result = await hedger.run(
+            answer("primary", after=5, cancelled=cancelled), answer("backup")
+        )
+        assert result == "backup"
+        assert (hedger.hedged, hedger.hedge_wins) == (1, 1)
+        await asyncio.sleep(0)
+        assert cancelled == ["primary"]
+
+    asyncio.run(run())
+
+
+def test_hedges_stay_within_the_budget():
+    async def run():
+        hedger = Hedger(budget=0, initial_delay=0.01)
+        result = await hedger.run(answer("primary", after=0.05), answer("backup"))
+        assert result == "primary"
+        assert (hedger.hedged, hedger.over_budget) == (0, 1)
+
+    asyncio.run(run())
+
+
+def test_the_working_answer_beats_a_failed_one():
+    async def run():
+        hedger = Hedger(budget=1, initial_delay=0.01)
+        result = await hedger.run(
+            answer(ConnectionError("primary"), after=0.02), answer("backup", after=0.05)
+        )
+        assert result == "backup"
+
+        with pytest.raises(ConnectionError):
+            await hedger.run(
+                answer(ConnectionError("primary"), after=0.02),
+                answer(ConnectionError("backup"), after=0.03),
+            )
+
+    asyncio.run(run())
+
+
+def test_the_delay_follows_recent_latencies():
+    hedger = Hedger(percentile=90, initial_delay=2, min_delay=0.05, min_samples=10)
+    assert hedger.delay() == 2
+    hedger.latencies.extend([0.1] * 9 + [1.0])
+    assert hedger.delay() == 1.0
+    hedger.latencies.extend([0.01] * 10)
+    assert hedger.delay() == 0.1
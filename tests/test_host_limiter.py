@@ -0,0 +1,104 @@
+"""
+How requests to a limited host wait for their turn and when they are shed.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+from time import monotonic
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from scrapers.ahttp import HostLimiter, HostLimits, UpstreamOverloaded  # noqa: E402
+
+
+async def hold(limiter, release):
+    async with limiter.slot():
+        await release.wait()
+
+
+def test_requests_beyond_the_concurrency_are_shed():
+    async def run():
+        limiter = HostLimiter(
+            "libgen.rs", HostLimits(rate=1000, burst=10, max_concurrency=1, max_wait=0.05)
+        )
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(hold(limiter, release))
+        await asyncio.sleep(0.01)
+        with pytest.raises(UpstreamOverloaded) as shed:
+            async with limiter.slot():
+                pass
+        assert shed.value.reason == "concurrency"
+
+        release.set()
+        await holder
+        # the shed request gave its place back
+        async with limiter.slot():
+            pass
+        assert limiter.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_requests_beyond_the_queue_are_shed_at_once():
+    async def run():
+        limiter = HostLimiter(
+            "libgen.rs",
+            HostLimits(rate=1000, burst=10, max_concurrency=1, max_queued=1, max_wait=5),
+        )
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(hold(limiter, release))
+        await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(hold(limiter, release))
+        await asyncio.sleep(0.01)
+        assert limiter.waiting == 1
+
+        start = monotonic()
+        with pytest.raises(UpstreamOverloaded) as shed:
+            async with limiter.slot():
+                pass
+        assert shed.value.reason == "queue full"
+        assert monotonic() - start < 1
+
+        release.set()
+        await asyncio.gather(holder, queued)
+
+    asyncio.run(run())
+
+
+def test_requests_wait_for_a_token_within_max_wait():
+    async def run():
+        limiter = HostLimiter(
+            "libgen.rs", HostLimits(rate=20, burst=1, max_concurrency=8, max_wait=1)
+        )
+        start = monotonic()
+        for _ in range(3):
+            async with limiter.slot():
+                pass
+        # the burst goes at once, the two after it wait 1/20 s each
+        assert 0.08 < monotonic() - start < 0.5
+
+    asyncio.run(run())
+
+
+def test_requests_whose_token_would_come_too_late_are_shed():
+    async def run():
+        limiter = HostLimiter(
+            "libgen.rs", HostLimits(rate=1, burst=1, max_concurrency=1, max_wait=0.1)
+        )
+        async with limiter.slot():
+            pass
+        with pytest.raises(UpstreamOverloaded) as shed:
+            async with limiter.slot():
+                pass
+        assert shed.value.reason == "rate"
+
+        # the concurrency slot taken before the rate check was given back
+        limiter.tokens = 1
+        async with limiter.slot():
+            pass
+
+    asyncio.run(run())
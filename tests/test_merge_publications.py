@@ -0,0 +1,90 @@
+"""
+How the federated search merges the publications several libraries found.
+
+    python -m pytest tests
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from misc import merge_publications  # noqa: E402
+from scrapers.objects import Publication  # noqa: E402
+
+MD5 = "0123456789abcdef0123456789abcdef"
+OTHER_MD5 = "fedcba9876543210fedcba9876543210"
+
+
+def publication(id, mirrors=(), isbn=None, extension="pdf"):
+    return Publication(
+        id=id,
+        authors=None,
+        isbn=isbn,
+        edition=None,
+        series=None,
+        title=f"Book {id}",
+        publisher=None,
+        year=None,
+        pages="",
+        lang="",
+        size="",
+        extension=extension,
+        mirrors=list(mirrors),
+    )
+
+
+def merged_ids(results):
+    return [(item["id"], item["libraries"]) for item in merge_publications(results)]
+
+
+def test_merges_the_same_file_across_libraries():
+    merged = merge_publications(
+        {
+            "libgen": [publication(1, [f"http://a/{MD5}"])],
+            "libgenlc": [publication(2, [f"http://b/{MD5.upper()}", "http://b/other"])],
+        }
+    )
+    assert len(merged) == 1
+    assert merged[0]["id"] == 1
+    assert merged[0]["libraries"] == ["libgen", "libgenlc"]
+    assert merged[0]["mirrors"] == [
+        f"http://a/{MD5}",
+        f"http://b/{MD5.upper()}",
+        "http://b/other",
+    ]
+
+
+def test_isbns_only_merge_the_same_format():
+    assert merged_ids(
+        {
+            "libgen": [publication(1, isbn=["978-0-00-000000-2"], extension="pdf")],
+            "libgenlc": [
+                publication(2, isbn=["9780000000002"], extension="epub"),
+                publication(3, isbn=["9780000000002"], extension="PDF"),
+            ],
+        }
+    ) == [(1, ["libgen", "libgenlc"]), (2, ["libgenlc"])]
+
+
+def test_never_merges_within_a_library():
+    assert merged_ids(
+        {
+            "libgen": [
+                publication(1, [f"http://a/{MD5}"]),
+                publication(2, [f"http://b/{MD5}"]),
+            ]
+        }
+    ) == [(1, ["libgen"]), (2, ["libgen"])]
+
+
+def test_merges_transitively():
+    # the first and the last share nothing but the middle one
+    assert merged_ids(
+        {
+            "libgen": [publication(1, [f"http://a/{MD5}"])],
+            "libgenlc": [publication(2, [f"http://b/{MD5}"], isbn=["9780000000002"])],
+            "planetebooks": [
+                publication(3, [f"http://c/{OTHER_MD5}"], isbn=["9780000000002"])
+            ],
+        }
+    ) == [(1, ["libgen", "libgenlc", "planetebooks"])]
@@ -0,0 +1,79 @@
+"""
+How the paginator fetches upstream pages ahead of clients walking the results.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from pagination import Paginator  # noqa: E402
+from scrapers.objects import SearchResult, SearchUrlArgs  # noqa: E402
+
+
+def urlargs(page, limit=25):
+    return SearchUrlArgs(
+        lang=None, page=page, limit=limit, offset=0, topic_id=None, search_mode=None
+    )
+
+
+def paginator(fetched):
+    async def search_page(library, search_term, urlargs):
+        fetched.append(urlargs.page)
+        start = (urlargs.page - 1) * urlargs.limit
+        publications = list(range(start, start + urlargs.limit))
+        return SearchResult(publications, 1000, (0, 0))
+
+    return Paginator(search_page, {"libgen": (25, 50, 100)})
+
+
+def test_only_a_following_request_prefetches():
+    async def run():
+        fetched = []
+        pages = paginator(fetched)
+        await pages.search("libgen", "python", urlargs(1))
+        await asyncio.sleep(0)
+        assert fetched == [1]
+
+        await pages.search("libgen", "Python ", urlargs(2))
+        await asyncio.sleep(0)
+        assert fetched == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_unrelated_requests_do_not_prefetch():
+    async def run():
+        fetched = []
+        pages = paginator(fetched)
+        await pages.search("libgen", "python", urlargs(1))
+        await pages.search("libgen", "python", urlargs(3))
+        await pages.search("libgen", "rust", urlargs(4))
+        await pages.search("libgen", "python", urlargs(4), prefetch=False)
+        await asyncio.sleep(0)
+        assert fetched == [1, 3, 4, 4]
+
+    asyncio.run(run())
+
+
+def test_the_last_page_is_read_up_to_the_window():
+    async def run():
+        asked = []
+
+        async def search_page(library, search_term, urlargs):
+            asked.append((urlargs.page, urlargs.limit, urlargs.wanted))
+            return SearchResult(list(range(urlargs.wanted)), 1000, (0, 0))
+
+        pages = Paginator(search_page, {"libgen": (25, 50, 100)})
+        result = await pages.search("libgen", "python", urlargs(1, limit=10))
+        assert asked == [(1, 25, 10)]
+        assert result.publications == list(range(10))
+
+        asked.clear()
+        result = await pages.search("libgen", "python", urlargs(4, limit=30))
+        assert asked == [(4, 25, 25), (5, 25, 20)]
+        assert result.publications == list(range(15, 25)) + list(range(20))
+
+    asyncio.run(run())
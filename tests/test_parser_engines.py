@@ -0,0 +1,84 @@
+"""
+Every parse method has a BeautifulSoup and an lxml implementation, these check
+that both read the recorded pages under benchmarks/fixtures the same way.
+
+    python -m pytest tests
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+from common import KIND_PARSERS, iter_fixtures, read_fixture  # noqa: E402
+
+from scrapers.genlibrusec import GenLibRusEc, ResultStream  # noqa: E402
+from scrapers.libgenlc import LibGenLc  # noqa: E402
+from scrapers.parsing import parse_page  # noqa: E402
+from scrapers.planetebooks import PlanetEBooks  # noqa: E402
+
+AGENTS = {
+    "libgen": GenLibRusEc,
+    "libgenlc": LibGenLc,
+    "planetebooks": PlanetEBooks,
+}
+FIXTURES = list(iter_fixtures())
+SEARCH_PAGES = [
+    path for library, kind, path in FIXTURES if (library, kind) == ("libgen", "search")
+]
+
+
+def strain_for(agent, kind):
+    return {
+        "search": agent.search_strain,
+        "topics": agent.topics_strain,
+        "datadumps": agent.datadumps_strain,
+        "suburl": getattr(agent, "suburl_soupstrain", None),
+    }[kind]
+
+
+def parse_with(engine, library, kind, content):
+    agent = AGENTS[library](engine=engine)
+    return parse_page(agent, KIND_PARSERS[kind], content, strain_for(agent, kind))
+
+
+@pytest.mark.parametrize(
+    "library, kind, path",
+    FIXTURES,
+    ids=[f"{library}-{kind}-{path.name}" for library, kind, path in FIXTURES],
+)
+def test_engines_parse_alike(library, kind, path):
+    content = read_fixture(path)
+    assert parse_with("lxml", library, kind, content) == parse_with(
+        "soup", library, kind, content
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [512, 16 * 1024])
+@pytest.mark.parametrize("path", SEARCH_PAGES)
+def test_result_stream_parses_like_parse_result(chunk_size, path):
+    content = read_fixture(path)
+    stream = ResultStream(GenLibRusEc())
+    for start in range(0, len(content), chunk_size):
+        stream.feed(content[start : start + chunk_size])
+    stream.close()
+    assert stream.result() == parse_with("soup", "libgen", "search", content)
+
+
+def test_engines_match_class_attributes_alike():
+    # strainers see the raw class attribute while the page is parsed, the
+    # lxml parsers have to match it as a whole too
+    page = """
+    <h2 class="fusion-post-title"><a href="/one/">One</a></h2>
+    <h2 class="fusion-post-title featured"><a href="/two/">Two</a></h2>
+    <p class="pelistlinks"><a href="/one.pdf">One</a></p>
+    <p class="pelistlinks new"><a href="/two.pdf">Two</a></p>
+    <h6>Penguin, 1920</h6>
+    <a class="buttonpe" href="/one.epub">EPUB</a>
+    <a class="buttonpe pdf" href="/one.pdf">PDF</a>
+    """
+    for kind in ("search", "datadumps", "suburl"):
+        assert parse_with("lxml", "planetebooks", kind, page) == parse_with(
+            "soup", "planetebooks", kind, page
+        )
@@ -0,0 +1,103 @@
+"""
+How identical in-flight calls are coalesced and what cancelling callers does
+to the shared call.
+
+    python -m pytest tests
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "freebooksapi"))
+
+from scrapers.singleflight import SingleFlight  # noqa: E402
+
+
+def test_concurrent_calls_share_one_outcome():
+    async def run():
+        flight = SingleFlight()
+        started = 0
+        release = asyncio.Event()
+
+        async def fetch():
+            nonlocal started
+            started += 1
+            await release.wait()
+            return "page"
+
+        callers = [asyncio.ensure_future(flight.run("key", fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert len(flight) == 1
+        release.set()
+        assert await asyncio.gather(*callers) == ["page"] * 3
+        assert started == 1
+        assert len(flight) == 0
+
+        # a call after the shared one ended starts afresh
+        assert await flight.run("key", fetch) == "page"
+        assert started == 2
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_caller():
+    async def run():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("upstream")
+
+        callers = [asyncio.ensure_future(flight.run("key", fail)) for _ in range(2)]
+        outcomes = await asyncio.gather(*callers, return_exceptions=True)
+        assert [type(outcome) for outcome in outcomes] == [ValueError, ValueError]
+        assert len(flight) == 0
+
+    asyncio.run(run())
+
+
+def test_a_cancelled_caller_leaves_the_others_waiting():
+    async def run():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "page"
+
+        leaving = asyncio.ensure_future(flight.run("key", fetch))
+        staying = asyncio.ensure_future(flight.run("key", fetch))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await staying == "page"
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+
+    asyncio.run(run())
+
+
+def test_the_last_caller_leaving_cancels_the_shared_call():
+    async def run():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.ensure_future(flight.run("key", fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert len(flight) == 0
+
+    asyncio.run(run())